@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+###############
+#  Run a paho mqtt client on an asyncio event loop instead of a loop_forever() thread.
+#
+#  The client's socket is watched with loop.add_reader()/add_writer(), which call
+#  paho's socket level loop_read()/loop_write(); a task calls loop_misc() once a
+#  second for keepalives and retries.  All mqtt callbacks then run on the event
+#  loop, alongside whatever other tasks the program has.
+#
+#  Used by MqttToDatabase.py, TimeSyncServer.py and TimeStampMqttDumper.py when
+#  started with --asyncio.
+###############
+import asyncio          #   https://docs.python.org/3/library/asyncio.html
+import logging          #   https://docs.python.org/3/library/logging.html
+import threading        #   https://docs.python.org/3/library/threading.html
+import paho.mqtt.client as mqtt     #   https://www.eclipse.org/paho/clients/python/docs/
+
+logger = logging.getLogger(__name__)
+
+class AsyncioMqttHelper:
+    '''
+    Hooks a paho client's socket callbacks to an asyncio event loop.
+
+    The register/unregister write callbacks may be called from other threads
+    (e.g. a publish() from an executor), so they are passed to the loop with
+    call_soon_threadsafe() when not already on the loop's thread.
+    '''
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.disconnected = None        # future set when the socket closes
+        self.loopThread = threading.get_ident()
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _onLoop(self, func, *args):
+        if threading.get_ident() == self.loopThread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        logger.debug('Mqtt socket opened.')
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.miscLoop())
+
+    def on_socket_close(self, client, userdata, sock):
+        logger.debug('Mqtt socket closed.')
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+        if self.disconnected is not None and not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._onLoop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._onLoop(self.loop.remove_writer, sock)
+
+    async def miscLoop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+async def RunForever(client, host, port, keepalive=60, maxBackoff=120):
+    '''
+    Connect client to host:port and keep it connected, like loop_forever(), but on
+    the running event loop.  Reconnects after a disconnect, backing off up to
+    maxBackoff seconds while the broker can't be reached.  Runs until cancelled.
+    '''
+    helper = AsyncioMqttHelper(asyncio.get_running_loop(), client)
+    backoff = 1
+    connected = False
+    while True:
+        helper.disconnected = helper.loop.create_future()
+        try:
+            if connected:
+                client.reconnect()
+            else:
+                client.connect(host, port, keepalive)
+                connected = True
+        except OSError as e:
+            logger.error('Mqtt connect to %s:%s failed (%s); retry in %d sec.', host, port, e, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff*2, maxBackoff)
+            continue
+        backoff = 1
+        try:
+            await helper.disconnected
+        finally:
+            if helper.misc is not None:
+                helper.misc.cancel()
+        logger.warning('Mqtt connection to %s:%s lost; reconnecting.', host, port)
+        await asyncio.sleep(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+###############
+#  Logging helpers for the mqtt programs' message paths.
+#
+#  StartQueueLogging() moves handler work (formatting, file writes, rotation) off
+#  the threads that log: each configured logger's handlers are replaced by one
+#  QueueHandler, and a QueueListener thread feeds the original handlers.
+#
+#  Child processes send their records to the parent with LogToQueue(), and the
+#  parent writes them with its own handlers (ReceiveFromQueue()), so only one
+#  process writes, and rotates, the log files.
+#
+#  MessageSampler picks which received messages get per-message debug logging,
+#  so debug logging can be left on at high message rates.
+#
+#  Used by MqttToDatabase.py, TimeSyncServer.py and TimeStampMqttDumper.py.
+###############
+import atexit           #   https://docs.python.org/3/library/atexit.html
+import logging          #   https://docs.python.org/3/library/logging.html
+import logging.handlers
+import queue            #   https://docs.python.org/3/library/queue.html
+import threading        #   https://docs.python.org/3/library/threading.html
+
+Listeners = []          # running QueueListeners
+
+def StartQueueLogging(loggerNames=('__main__',)):
+    '''
+    Put a QueueHandler in front of the handlers of the root logger and of the
+    named loggers, as configured by logging.config.dictConfig().  Call once,
+    after configuring logging.  The listeners are stopped, and what they hold
+    written, by StopQueueLogging(), which also runs at exit.
+    '''
+    loggers = [logging.getLogger()] + [logging.getLogger(n) for n in loggerNames]
+    for lg in loggers:
+        if len(lg.handlers) == 0 or any(isinstance(h, logging.handlers.QueueHandler) for h in lg.handlers):
+            continue
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(q, *lg.handlers, respect_handler_level=True)
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+        lg.addHandler(logging.handlers.QueueHandler(q))
+        listener.start()
+        Listeners.append(listener)
+
+def StopQueueLogging():
+    while len(Listeners) > 0:
+        Listeners.pop().stop()
+
+atexit.register(StopQueueLogging)
+
+def LogToQueue(q, level):
+    '''
+    In a child process, instead of configuring logging: send every record of level
+    or above to q, a multiprocessing queue read by ReceiveFromQueue() in the parent.
+    '''
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.setLevel(level)
+
+def ReceiveFromQueue(q):
+    '''
+    In the parent: a daemon thread that logs the records child processes put on q
+    through the parent's logger of the same name.  Put None on q to stop it.
+    '''
+    def receive():
+        while True:
+            record = q.get()
+            if record is None:
+                return
+            logging.getLogger(record.name).handle(record)
+    thread = threading.Thread(target=receive, name='ChildLogReceiver', daemon=True)
+    thread.start()
+    return thread
+
+class MessageSampler:
+    '''
+    Call once per message: True if this message's debug lines should be logged.
+
+    every = 1 logs every message, N logs one message in N, 0 logs none.  Always
+    False when the logger does not log DEBUG, so disabled debug logging costs a
+    counter and a level check per message.  The count is not locked; with several
+    writer threads the sampling is only approximately one in N.
+    '''
+    def __init__(self, logger, every=1):
+        self.logger = logger
+        self.every = max(0, every)
+        self.count = 0
+
+    def __call__(self):
+        if self.every == 0 or not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            return True
+        return False
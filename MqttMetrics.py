@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+###############
+#  Counters, gauges and histograms for the mqtt programs, exposed in Prometheus
+#  text format (https://prometheus.io/docs/instrumenting/exposition_formats/)
+#  over a small local HTTP server, and as a JSON snapshot for publishing on an
+#  mqtt topic.
+#
+#  Only the standard library is used.  Updating a metric takes one lock, so it
+#  is cheap enough for the per-message path.
+#
+#  Used by MqttToDatabase.py.
+###############
+import http.server      #   https://docs.python.org/3/library/http.server.html
+import json             #   https://docs.python.org/3/library/json.html
+import logging          #   https://docs.python.org/3/library/logging.html
+import math
+import threading        #   https://docs.python.org/3/library/threading.html
+
+logger = logging.getLogger(__name__)
+
+LatencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SizeBuckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def _labelText(labelNames, labels):
+    if len(labelNames) == 0:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for n, v in zip(labelNames, labels)) + '}'
+
+def _number(v):
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += self.samples()
+        return lines
+
+class Counter(Metric):
+    ''' A count that only goes up, per label values. '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labelNames=()):
+        super().__init__(name, help, labelNames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [f'{self.name}{_labelText(self.labelNames, k)} {_number(v)}' for k, v in values]
+
+    def snapshot(self):
+        with self.lock:
+            return {self.name + _labelText(self.labelNames, k): v for k, v in self.values.items()}
+
+class Gauge(Counter):
+    ''' A value that is set, e.g. a queue depth. '''
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Callback(Metric):
+    ''' A counter or gauge whose value is read from func() when rendered. '''
+    def __init__(self, name, help, kind, func):
+        super().__init__(name, help)
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        return [f'{self.name} {_number(self.func())}']
+
+    def snapshot(self):
+        return {self.name: self.func()}
+
+class Histogram(Metric):
+    '''
+    Counts of observations in cumulative buckets, per label values, with their
+    sum.  quantile() estimates a quantile from the buckets by linear
+    interpolation, as Prometheus' histogram_quantile() does.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LatencyBuckets, labelNames=()):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.series = {}            # labels => [bucket counts..., sum]
+
+    def observe(self, value, *labels):
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0]*len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    s[i] += 1
+                    break
+            s[-1] += value
+
+    def _cumulative(self, labels):
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                return None, 0.0
+            counts, total = s[:-1], s[-1]
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, total
+
+    def count(self, *labels):
+        cumulative, total = self._cumulative(labels)
+        return cumulative[-1] if cumulative else 0
+
+    def quantile(self, q, *labels):
+        ''' Estimated q quantile (0..1) of the observations, or None if there are none. '''
+        cumulative, total = self._cumulative(labels)
+        if not cumulative or cumulative[-1] == 0:
+            return None
+        rank = q * cumulative[-1]
+        lower, below = 0.0, 0
+        for bound, c in zip(self.buckets, cumulative):
+            if c >= rank:
+                if bound == math.inf:
+                    return lower            # can't interpolate into the +Inf bucket
+                return lower + (bound - lower) * ((rank - below) / (c - below) if c > below else 0)
+            lower, below = bound, c
+        return lower
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            keys = list(self.series)
+        for labels in keys:
+            cumulative, total = self._cumulative(labels)
+            for bound, c in zip(self.buckets, cumulative):
+                lines.append(f'{self.name}_bucket{_labelText(self.labelNames + ("le",), labels + (_number(bound),))} {c}')
+            lines.append(f'{self.name}_sum{_labelText(self.labelNames, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labelText(self.labelNames, labels)} {cumulative[-1]}')
+        return lines
+
+    def snapshot(self):
+        result = {}
+        with self.lock:
+            keys = list(self.series)
+        for labels in keys:
+            cumulative, total = self._cumulative(labels)
+            name = self.name + _labelText(self.labelNames, labels)
+            result[name] = {'count': cumulative[-1], 'sum': total,
+                            'p50': self.quantile(0.5, *labels), 'p99': self.quantile(0.99, *labels)}
+        return result
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelNames=()):
+        return self.add(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()):
+        return self.add(Gauge(name, help, labelNames))
+
+    def callback(self, name, help, kind, func):
+        return self.add(Callback(name, help, kind, func))
+
+    def histogram(self, name, help, buckets=LatencyBuckets, labelNames=()):
+        return self.add(Histogram(name, help, buckets, labelNames))
+
+    def render(self):
+        ''' All metrics in Prometheus text exposition format. '''
+        lines = []
+        for m in self.metrics:
+            try:
+                lines += m.render()
+            except Exception as e:
+                logger.warning('Metric %s not rendered: %s', m.name, e)
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        ''' All metrics as one dict, e.g. for a JSON mqtt message. '''
+        result = {}
+        for m in self.metrics:
+            try:
+                result.update(m.snapshot())
+            except Exception as e:
+                logger.warning('Metric %s not in snapshot: %s', m.name, e)
+        return result
+
+    def json(self):
+        return json.dumps(self.snapshot(), separators=(',', ':'))
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request from %s: ' + format, self.address_string(), *args)
+
+def StartServer(registry, port, host='127.0.0.1'):
+    ''' Serve registry on http://host:port/metrics from a daemon thread; returns the server. '''
+    handler = type('MetricsHandler', (_Handler,), {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return server
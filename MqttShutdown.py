@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+###############
+#  Orderly shutdown for the mqtt programs.
+#
+#  SIGTERM or SIGHUP, or the ${HOME}/.Close<ProgName> "magic file" that the
+#  Start*.sh scripts create, asks the program to stop.  A watcher thread waits for
+#  either and then calls the program's stop function once, so the program can
+#  leave its receive loop, drain its queues and flush what it has buffered.
+#  The magic file is looked for every few seconds by the watcher thread, instead
+#  of on every received message.
+#
+#  Used by MqttToDatabase.py, TimeSyncServer.py and TimeStampMqttDumper.py.
+###############
+import logging          #   https://docs.python.org/3/library/logging.html
+import os               #   https://docs.python.org/3/library/os.html
+import signal           #   https://docs.python.org/3/library/signal.html
+import threading        #   https://docs.python.org/3/library/threading.html
+
+logger = logging.getLogger(__name__)
+
+class ShutdownWatcher:
+    '''
+    Calls stop() once, on the watcher thread, when a stop signal arrives or the
+    magic quit file appears.  The magic file is deleted when it is seen, so it
+    does not stop the next run too.
+
+    The signal handlers only record the request and wake the watcher thread;
+    nothing that takes locks (logging, mqtt client calls) runs in a signal handler.
+    '''
+    Signals = tuple(s for s in (getattr(signal, 'SIGTERM', None), getattr(signal, 'SIGHUP', None)) if s is not None)
+
+    def __init__(self, magicQuitPath, pollSec=5.0):
+        self.magicQuitPath = magicQuitPath
+        self.pollSec = max(0.1, pollSec)
+        self.event = threading.Event()
+        self.reason = None
+        self.stop = None
+        self.thread = None
+
+    @property
+    def requested(self):
+        return self.event.is_set()
+
+    def start(self, stop):
+        ''' Install the signal handlers (must be called on the main thread) and start watching. '''
+        self.stop = stop
+        for s in self.Signals:
+            signal.signal(s, self._onSignal)
+        self.thread = threading.Thread(target=self._run, name='ShutdownWatcher', daemon=True)
+        self.thread.start()
+
+    def request(self, reason):
+        ''' Ask for shutdown, e.g. from the program itself. '''
+        if self.reason is None:
+            self.reason = reason
+        self.event.set()
+
+    def _onSignal(self, signum, frame):
+        self.request(signal.Signals(signum).name)
+
+    def _run(self):
+        while not self.event.wait(self.pollSec):
+            if os.path.exists(self.magicQuitPath):
+                try:
+                    os.remove(self.magicQuitPath)
+                except OSError as e:
+                    logger.warning('Could not delete magic file "%s": %s', self.magicQuitPath, e)
+                self.request(f'magic file "{self.magicQuitPath}" exists')
+        logger.info('Quitting because %s.', self.reason)
+        try:
+            self.stop()
+        except Exception as e:
+            logger.exception(e)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3.11
 
 import mysql.connector
+import mysql.connector.pooling
 from mysql.connector import Error as SqlError
+from mysql.connector.errors import InterfaceError as SqlInterfaceError, OperationalError as SqlOperationalError
 import time
 from datetime import datetime as dt #   https://docs.python.org/3/library/datetime.html#datetime-objects
 from datetime import timezone       #   https://docs.python.org/3/library/datetime.html#date-objects
@@ -13,11 +15,34 @@ import re               #   https://docs.python.org/3/library/re.html
 import argparse         #   https://docs.python.org/3/library/argparse.html
 import paho.mqtt.client as mqtt     #   https://www.eclipse.org/paho/clients/python/docs/
 import paho.mqtt.publish as publish
+import MqttAsyncio
+import MqttShutdown
+import MqttLogging
+import MqttMetrics
 import configparser
+import tomllib
+import threading
+from collections import OrderedDict
+import queue
+import asyncio
+import concurrent.futures
+import multiprocessing
+import signal
+import struct
+import zlib
+import mmap
+import fcntl
 import logging
 import logging.config
 import logging.handlers
 import json
+import math
+try:
+    import orjson       #   https://github.com/ijl/orjson  -- optional, much faster JSON parsing
+    JsonLoads = orjson.loads
+except ImportError:
+    orjson = None
+    JsonLoads = json.loads
 
 from prodict import Prodict             #   https://github.com/ramazanpolat/prodict
 from progparams.ProgramParametersDefinitions import MakeParams
@@ -27,28 +52,79 @@ ProgName, ext = os.path.splitext(os.path.basename(sys.argv[0]))
 ProgPath = os.path.dirname(os.path.realpath(sys.argv[0]))
 
 ##############Logging Settings##############
-config_dict = GetLoggingDict(ProgName, ProgPath)
-logging.config.dictConfig(config_dict)
+#   A worker process (RunWorkerProcesses) imports this file as "__mp_main__".  It
+# logs as "__main__" too, and sends its records to the receive process, which
+# alone writes the log files (WorkerProcess).
+IsWorkerProcess = __name__ == '__mp_main__'
+if not IsWorkerProcess:
+    config_dict = GetLoggingDict(ProgName, ProgPath)
+    logging.config.dictConfig(config_dict)
+    MqttLogging.StartQueueLogging()         # file writes happen on listener threads, not message threads
 
-logger = logging.getLogger(__name__)
-logger.info('logger name is: "%s"', logger.name)
+logger = logging.getLogger('__main__' if IsWorkerProcess else __name__)
+if not IsWorkerProcess:
+    logger.info('logger name is: "%s"', logger.name)
 
 console = logger
 
 debug = logger.debug
 info = logger.info
 critical = logger.critical
-
-logger.level = logging.DEBUG
+MsgDebug = MqttLogging.MessageSampler(logger)      # True for the messages whose processing is debug logged
 
 ########################  GLOBALS
 PP = Prodict()
 
-DBConn = None
-DBCursor = None
+DbConfig = None         # mysql.connector connect arguments
+DbPool = None           # MySQLConnectionPool shared by the writer threads
+DbPoolLock = threading.Lock()
+DbSessions = threading.local()  # each thread's DbSession
 dontWriteDb = False
-Topics = set()    # default topics to subscribe
+Brokers = {}      # broker name => Broker we receive from
 mqtt_msg_table = None
+IngestQueue = None      # Bounded queue between on_message and the DB writer threads (asyncio.Queue in asyncio mode)
+DbExecutor = None       # asyncio mode: the one thread that runs blocking DB work
+Writers = []            # DB writer threads
+QueueStats = {'enqueued': 0, 'dropped': 0, 'spilled': 0, 'highWater': 0}
+Routes = None           # TopicTrie of routing rules
+Deadband = None         # DeadbandFilter for routes with deadband settings
+Rollups = None          # RollupAggregator for routes with rollup = true
+Devices = None          # DeviceCoalescer for DeviceTable upserts
+Journal = None          # SpillJournal for messages the queue or database can't accept
+StrandedJournals = []   # SpillJournals left in JournalDir by processes no longer running
+JournalDirLock = None   # fd of this instance's flock()ed journal directory (ClaimJournalDir)
+Spiller = None          # SpillWriter that journals messages the full ingest queue can't take
+SourceColumns = ()      # (SourceColumn,) when receiving from several brokers, else ()
+Shutdown = None         # MqttShutdown.ShutdownWatcher: SIGTERM/SIGHUP or the magic quit file
+WorkerQueueChunks = 8   # chunks of received items waiting for each worker process before the forwarder blocks
+PrevTimeStamp = 0       # microsec since epoch of the last receive time given out
+PrevTimeStampLock = threading.Lock()    # on_message runs on each broker's network thread
+
+Metrics = MqttMetrics.Registry()        # served on MetricsPort, published on MetricsTopic
+MReceived = Metrics.counter('mqtttodb_messages_received_total', 'Messages received, by broker.', ('broker',))
+MRouted = Metrics.counter('mqtttodb_messages_routed_total', 'Messages processed, by matching route (topic class) and action.', ('route', 'action'))
+MDecodeFailures = Metrics.counter('mqtttodb_decode_failures_total', 'Messages ignored because the payload is not UTF-8.')
+MConnects = Metrics.counter('mqtttodb_mqtt_connects_total', 'Connections and reconnections to a broker, by result code.', ('broker', 'rc'))
+MDisconnects = Metrics.counter('mqtttodb_mqtt_disconnects_total', 'Lost broker connections.', ('broker',))
+MRowsInserted = Metrics.counter('mqtttodb_db_rows_written_total', 'Rows committed, by table.', ('table',))
+MBatchRows = Metrics.histogram('mqtttodb_db_batch_rows', 'Rows per message batch written.', MqttMetrics.SizeBuckets)
+MStatementSeconds = Metrics.histogram('mqtttodb_db_statement_seconds', 'Time to execute one multi-row statement.')
+MCommitSeconds = Metrics.histogram('mqtttodb_db_commit_seconds', 'Time to commit.')
+MBatchFailures = Metrics.counter('mqtttodb_db_batch_failures_total', 'Batches the database did not accept.', ('kind',))
+MDbLost = Metrics.counter('mqtttodb_db_connections_lost_total', 'Database connections dropped after an error or failed health check.')
+StageBuckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025) + MqttMetrics.LatencyBuckets + (30.0, 60.0, 300.0, 3600.0)
+LatencyStages = ('queue', 'decode', 'route', 'batch', 'execute', 'commit', 'end_to_end', 'device')
+MLatency = Metrics.histogram('mqtttodb_latency_seconds', 'Time messages spend in each stage: queue wait, decode, route, '
+    'wait in batch, execute, commit; end_to_end is receive to commit; device is device timestamp to receive.', StageBuckets, ('stage',))
+Metrics.callback('mqtttodb_ingest_queue_depth', 'Messages waiting in the ingest queue.', 'gauge',
+    lambda: IngestQueue.qsize() if IngestQueue is not None else 0)
+Metrics.callback('mqtttodb_ingest_queue_high_water', 'Most messages waiting in the ingest queue.', 'gauge', lambda: QueueStats['highWater'])
+Metrics.callback('mqtttodb_messages_enqueued_total', 'Messages put on the ingest queue.', 'counter', lambda: QueueStats['enqueued'])
+Metrics.callback('mqtttodb_messages_dropped_total', 'Messages lost because the ingest queue was full.', 'counter', lambda: QueueStats['dropped'])
+Metrics.callback('mqtttodb_messages_spilled_total', 'Messages journaled because the ingest queue was full.', 'counter', lambda: QueueStats['spilled'])
+Metrics.callback('mqtttodb_deadband_suppressed_total', 'Rows not written because of deadband filtering.', 'counter',
+    lambda: Deadband.suppressed if Deadband is not None else 0)
+
 RequiredConfigParams = frozenset((   'inserter_user',
                                      'inserter_password',
                                      'inserter_host',
@@ -63,13 +139,64 @@ magicQuitPath = os.path.expandvars('${HOME}/.Close%s'%ProgName)     # Don't use
 '''
 mqttmessages table creation:
 CREATE TABLE `mqttmessages` (
-  `RecTime` timestamp(6) NOT NULL DEFAULT current_timestamp(6),
+  `RecTime` timestamp(6) NOT NULL,
   `topic` tinytext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
   `message` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
   PRIMARY KEY (`RecTime`),
   UNIQUE KEY `RecTime` (`RecTime`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb3 COLLATE=utf8mb3_general_ci;
 
+mqttvalues table creation (typed values extracted from JSON messages by "extract" routes):
+CREATE TABLE `mqttvalues` (
+  `RecTime` timestamp(6) NOT NULL,
+  `topic` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `field` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `value` double DEFAULT NULL,
+  `devtime` timestamp(6) NULL DEFAULT NULL,
+  PRIMARY KEY (`topic`, `field`, `RecTime`),
+  KEY `RecTime` (`RecTime`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb3 COLLATE=utf8mb3_general_ci;
+
+RecTime is the receive time given by the program (ReceiveTime()), not the insert time, and
+is unique and increasing within one program instance, so batched, multi-writer and replayed
+inserts keep the time each message arrived.  Tables created with the old
+DEFAULT current_timestamp(6) need:
+ALTER TABLE `mqttmessages` ALTER COLUMN `RecTime` DROP DEFAULT;
+Separately started instances (e.g. several sharing a ShareGroup) each give out their own
+times, so they can coincide; give each its own MsgTable, or add the topic to the key.
+
+Partitioning (PartitionBy parameter): the message and value tables can be RANGE
+partitioned on RecTime by day or by month, so that old rows go a partition at a time.
+The program adds partitions ahead of time and drops (or archives) expired ones, but does
+not partition a table itself, as that rewrites the whole table.  With the session time
+zone set to UTC ('+00:00'), e.g. monthly:
+ALTER TABLE `mqttmessages` PARTITION BY RANGE (UNIX_TIMESTAMP(`RecTime`)) (
+  PARTITION p202401 VALUES LESS THAN (UNIX_TIMESTAMP('2024-02-01 00:00:00')),
+  PARTITION pfuture VALUES LESS THAN MAXVALUE);
+The last partition must be the MAXVALUE one.  Every unique key must include RecTime, as
+the keys above do.
+
+When receiving from several brokers (Brokers parameter), the message and value tables need
+the broker name column (SourceColumn):
+ALTER TABLE `mqttmessages` ADD COLUMN `source` varchar(64) NOT NULL DEFAULT '';
+ALTER TABLE `mqttvalues` ADD COLUMN `source` varchar(64) NOT NULL DEFAULT '';
+and so do the rollup tables, in their primary key:
+ALTER TABLE `mqttrollup_minute` ADD COLUMN `source` varchar(64) NOT NULL DEFAULT '',
+  DROP PRIMARY KEY, ADD PRIMARY KEY (`source`, `topic`, `field`, `WindowStart`);
+
+Rollup tables (one per resolution: <prefix>_minute, <prefix>_hour, <prefix>_day; prefix from RollupTablePrefix):
+CREATE TABLE `mqttrollup_minute` (
+  `topic` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `field` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `WindowStart` timestamp NOT NULL,
+  `cnt` int unsigned NOT NULL,
+  `vmin` double NOT NULL,
+  `vmax` double NOT NULL,
+  `vmean` double NOT NULL,
+  PRIMARY KEY (`topic`, `field`, `WindowStart`),
+  KEY `WindowStart` (`WindowStart`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb3 COLLATE=utf8mb3_general_ci;
+
 mqttdevice table creation:
 CREATE OR REPLACE TABLE `mqttdevices` (
   `deviceid` char(64) NOT NULL,
@@ -79,136 +206,1845 @@ CREATE OR REPLACE TABLE `mqttdevices` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb3 COLLATE=utf8mb3_general_ci;
 '''
 
+class MsgBatcher:
+    '''
+    Gathers rows for the message table and writes them with one multi-row INSERT.
+
+    A batch is flushed when it holds maxRows rows, or when its oldest row has
+    waited maxLatency seconds, whichever happens first.  Each writer thread owns
+    its own batch, so no locking is needed here.
+    '''
+    def __init__(self, maxRows, maxLatency, flushFunc):
+        self.maxRows = max(1, maxRows)
+        self.maxLatency = max(0.0, maxLatency)
+        self.flushFunc = flushFunc          # called with a list of rows; must not raise
+        self.rows = []
+        self.deadline = None                # monotonic time by which current batch must be written
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.maxLatency
+        if len(self.rows) >= self.maxRows:
+            self.flush()
+
+    def timeout(self):
+        ''' Seconds until the current batch is due, or None if the batch is empty. '''
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def flushIfDue(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        rows = self.rows
+        self.rows = []
+        self.deadline = None
+        if len(rows) > 0:
+            self.flushFunc(rows)
+
+class TopicTrie:
+    '''
+    MQTT topic filters (with + and # wildcards) compiled into a trie of topic levels.
+
+    match() walks one trie level per topic level, trying the literal level before
+    + before #, so the most specific filter wins.  Each filter holds a list of
+    values; the first value accepted by the caller's predicate is returned.
+    '''
+    class Node:
+        __slots__ = ('children', 'values')
+        def __init__(self):
+            self.children = {}
+            self.values = []
+
+    def __init__(self):
+        self.root = self.Node()
+        self.count = 0
+
+    def insert(self, topicFilter, value):
+        node = self.root
+        for level in topicFilter.split('/'):
+            node = node.children.setdefault(level, self.Node())
+        node.values.append(value)
+        self.count += 1
+
+    def match(self, topic, accept=lambda v: True):
+        levels = topic.split('/')
+        return self._match(self.root, levels, 0, accept, topic.startswith('$'))
+
+    def _match(self, node, levels, i, accept, isSys):
+        if i == len(levels):
+            for value in node.values:
+                if accept(value):
+                    return value
+            node = node.children.get('#')       # "a/#" also matches "a"
+            return None if node is None else self._first(node, accept)
+        level = levels[i]
+        child = node.children.get(level)
+        if child is not None:
+            value = self._match(child, levels, i + 1, accept, isSys)
+            if value is not None:
+                return value
+        if i == 0 and isSys:                    # wildcards don't match $SYS style topics
+            return None
+        child = node.children.get('+')
+        if child is not None:
+            value = self._match(child, levels, i + 1, accept, isSys)
+            if value is not None:
+                return value
+        child = node.children.get('#')
+        return None if child is None else self._first(child, accept)
+
+    def _first(self, node, accept):
+        for value in node.values:
+            if accept(value):
+                return value
+        return None
+
+#   Routes that reproduce the original fixed routing.  Routes from the routes file
+# come first, so a file route for the same topic filter takes precedence.
+#   The original code matched any topic ending in "/status" and any "homeassistant..."
+# topic ending in "config", at any depth.  Topic filters can't match a suffix, so the
+# defaults spell out each depth up to DefaultRouteDepth levels; deeper topics fall
+# through to the "#" routes.
+DefaultRouteDepth = 8
+DefaultRoutes = [
+    *({'topic': '+/' * n + 'status', 'action': 'device', 'idField': 'MachineID', 'timeField': 'StatusTime', 'subscribe': True}
+        for n in range(1, DefaultRouteDepth)),
+    *({'topic': 'homeassistant/' + '+/' * n + 'config', 'action': 'device', 'retained': True, 'idField': 'uniq_id'}
+        for n in range(0, DefaultRouteDepth - 1)),
+    {'topic': '#', 'action': 'ignore', 'retained': True},       # other retained messages
+    {'topic': '#', 'action': 'table'},
+]
+RouteActions = frozenset(('table', 'ignore', 'device', 'transform', 'extract'))
+MsgColumns = ('RecTime', 'topic', 'message')
+ValueColumns = ('RecTime', 'topic', 'field', 'value', 'devtime')
+
+DeadbandKeys = ('deadband', 'deadbandPercent', 'maxSilenceSec', 'changeOnly')
+
+class DeadbandFilter:
+    '''
+    Suppresses writes of values that have not changed meaningfully.
+
+    For a route with any of the DeadbandKeys, each (topic, field) value is written
+    only if it differs from the last written value by more than deadband
+    (absolute) or deadbandPercent (of the last value), or by anything at all
+    if neither is given; or if maxSilenceSec has passed since the last write.
+    Non-numeric values are written when they change.  The field None stands for
+    the whole message: it is compared by its deadbandField if the route has one,
+    else by its payload (as a number if it is one).
+
+    The last written values are kept in an LRU cache of maxEntries keys.
+    '''
+    def __init__(self, maxEntries):
+        self.maxEntries = max(1, maxEntries)
+        self.cache = OrderedDict()      # (topic, field) => (value, RecTime)
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    @staticmethod
+    def applies(route):
+        return any(route.get(k) is not None for k in DeadbandKeys)
+
+    def passes(self, route, topic, field, value, recTime):
+        key = (topic, field)
+        with self.lock:
+            last = self.cache.get(key)
+            if last is not None:
+                lastValue, lastTime = last
+                if recTime <= lastTime:         # journal replay of this or an older write that failed; keep cache
+                    return True
+                if not self.changed(route, lastValue, value) and not self.silent(route, lastTime, recTime):
+                    self.cache.move_to_end(key)
+                    self.suppressed += 1
+                    return False
+            self.cache[key] = (value, recTime)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.maxEntries:
+                self.cache.popitem(last=False)
+            return True
+
+    @staticmethod
+    def changed(route, lastValue, value):
+        numbers = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (lastValue, value))
+        if not numbers or route.get('changeOnly') and route.get('deadband') is None and route.get('deadbandPercent') is None:
+            return value != lastValue
+        delta = abs(value - lastValue)
+        if route.get('deadband') is not None and delta > float(route.deadband):
+            return True
+        if route.get('deadbandPercent') is not None and delta > abs(lastValue)*float(route.deadbandPercent)/100.0:
+            return True
+        if route.get('deadband') is None and route.get('deadbandPercent') is None:
+            return delta != 0
+        return False
+
+    @staticmethod
+    def silent(route, lastTime, recTime):
+        maxSilence = route.get('maxSilenceSec')
+        return maxSilence is not None and (recTime - lastTime).total_seconds() >= float(maxSilence)
+
+class RollupAggregator:
+    '''
+    Streaming per-(source, topic, field) count/min/max/mean of extracted values over
+    minute, hour and day windows aligned to UTC.  source is the broker name, which
+    goes in the SourceColumns.
+
+    flush() upserts every window that ended more than graceSec ago (all windows
+    at shutdown) into its resolution's table.  The upsert merges with a row
+    already there, so late values and restarts in the middle of a window add
+    to the stored statistics instead of replacing them.  Windows are kept and
+    retried at the next flush while the database can't be reached; if it rejects
+    the upsert (e.g. a missing rollup table) they are logged and dropped.
+    '''
+    Resolutions = (('minute', 60), ('hour', 3600), ('day', 86400))
+    Epoch = dt(1970, 1, 1)
+    UpsertTail = (' ON DUPLICATE KEY UPDATE vmean=(vmean*cnt + VALUES(vmean)*VALUES(cnt))/(cnt + VALUES(cnt)),'
+                  ' cnt=cnt + VALUES(cnt), vmin=LEAST(vmin, VALUES(vmin)), vmax=GREATEST(vmax, VALUES(vmax))')   # vmean before cnt
+
+    def __init__(self, tablePrefix, graceSec):
+        self.tablePrefix = tablePrefix
+        self.graceSec = graceSec
+        self.windows = {}           # (resolution, source, topic, field, WindowStart) => [count, min, max, sum]
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+
+    def add(self, source, topic, field, value, recTime):
+        seconds = (recTime - self.Epoch) // timedelta(seconds=1)
+        with self.lock:
+            for name, length in self.Resolutions:
+                self._merge((name, source, topic, field, self.Epoch + timedelta(seconds=seconds - seconds % length)), [1, value, value, value])
+
+    def _merge(self, key, stats):
+        w = self.windows.get(key)
+        if w is None:
+            self.windows[key] = stats
+        else:
+            w[0] += stats[0]
+            w[1] = min(w[1], stats[1])
+            w[2] = max(w[2], stats[2])
+            w[3] += stats[3]
+
+    def flush(self, everything=False):
+        with self.flushLock:
+            now = dt.now(timezone.utc).replace(tzinfo=None)
+            lengths = dict(self.Resolutions)
+            with self.lock:
+                closed = {k: w for k, w in self.windows.items()
+                          if everything or (now - k[4]).total_seconds() >= lengths[k[0]] + self.graceSec}
+                for k in closed:
+                    del self.windows[k]
+            if len(closed) == 0:
+                return
+            byTable = {}
+            for (name, source, topic, field, start), (count, vmin, vmax, vsum) in closed.items():
+                byTable.setdefault(f'{self.tablePrefix}_{name}', []).append(
+                    (topic, field, start, count, vmin, vmax, vsum/count) + (source,)*len(SourceColumns))
+            columns = ', '.join(('topic', 'field', 'WindowStart', 'cnt', 'vmin', 'vmax', 'vmean') + SourceColumns)
+            rowValues = '(' + ', '.join(['%s']*(7 + len(SourceColumns))) + ')'
+            session = CurrentSession()
+            if session.get() is not None:
+                try:
+                    for table, rows in byTable.items():
+                        ExecuteRows(session, f"""INSERT INTO `{PP.DbSchema}`.`{table}` ({columns})""",
+                                    rowValues, rows, sqlTail=self.UpsertTail, maxRows=int(PP.BatchMaxRows))
+                    session.commit()
+                    info('Wrote %d rollup windows.', len(closed))
+                    for table, rows in byTable.items():
+                        MRowsInserted.inc(table, amount=len(rows))
+                    return
+                except SqlError as e:
+                    MBatchFailures.inc('rollups')
+                    session.failed(e)
+                    if not IsConnectionError(e):
+                        logger.error('Database rejected %d rollup windows, which are dropped: %s', len(closed), e)
+                        return
+                    logger.error('Could not write %d rollup windows; kept for retry: %s', len(closed), e)
+            else:
+                logger.error('No database connection; %d rollup windows kept for retry.', len(closed))
+            with self.lock:
+                for k, w in closed.items():
+                    self._merge(k, w)
+
+def MessageFilterValue(route, decodedMsg, msgDict):
+    ''' The value a deadband route compares for the whole message. '''
+    if route.get('deadbandField') is not None:
+        if msgDict is None:
+            msgDict = ParseJsonObject(decodedMsg)
+        value = None if msgDict is None else JsonField(msgDict, route.deadbandField)
+    else:
+        value = decodedMsg
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    return value
+
+def LoadRoutes(routesFile):
+    '''
+    Build the routing TopicTrie from the [[Route]] tables in routesFile (if it exists)
+    followed by DefaultRoutes (unless the file sets replaceDefaults = true).
+    Route keys:
+      topic      -- MQTT topic filter; required
+      action     -- table | ignore | device | transform | extract; required
+      retained   -- if given, route applies only to messages whose retain flag equals this
+      table      -- table / transform: table for the message; default MsgTable
+      fields     -- transform: JSON fields kept in the stored message
+      extract    -- table / transform / extract: JSON fields (dotted paths) written as numbers to valueTable
+      valueTable -- table for extracted values; default ValueTable
+      deadband, deadbandPercent, maxSilenceSec, changeOnly, deadbandField
+                 -- table / transform / extract: write filter, see DeadbandFilter
+      rollup     -- table / transform / extract: also keep minute/hour/day statistics of the extract fields
+      idField    -- device: JSON field holding the deviceid
+      timeField  -- device: JSON field holding the status time; default is the receive time
+                    table / transform / extract: JSON field holding the device's own time of the values
+      subscribe  -- device: subscribe to "<deviceid>/#"
+    '''
+    routes = []
+    replaceDefaults = False
+    if routesFile and os.path.isfile(routesFile):
+        with open(routesFile, 'rb') as f:
+            rc = tomllib.load(f)
+        routes = rc.get('Route', [])
+        replaceDefaults = rc.get('replaceDefaults', False)
+        info('Loaded %d routes from "%s".', len(routes), routesFile)
+    if not replaceDefaults:
+        routes = routes + DefaultRoutes
+    trie = TopicTrie()
+    for r in routes:
+        route = Prodict.from_dict(r)
+        if route.get('topic') is None or route.get('action') not in RouteActions:
+            logger.error('Route %s needs a topic and an action in %s; route ignored.', r, sorted(RouteActions))
+            continue
+        if route.action == 'device' and route.get('idField') is None:
+            logger.error('Device route %s needs an idField; route ignored.', r)
+            continue
+        if route.action == 'extract' and not route.get('extract'):
+            logger.error('Extract route %s needs an extract list of fields; route ignored.', r)
+            continue
+        trie.insert(route.topic, route)
+    return trie
+
+class SpillJournal:
+    '''
+    Append-only, segment-rotated on-disk journal of received messages.
+
+    Each record is a (RecTime, topic, payload, retain, source) item exactly as received,
+    so replay runs it through the normal processing path with its original receive time.
+    The monotonic receive stamp is not kept; replayed items have None.
+    Record layout: <len:u32><crc32:u32> then body = <RecTime usec:i64><flags:u8><topicLen:u16><topic>
+    [<sourceLen:u8><source>]<payload>.
+    flags bit 0 is the retain flag; bit 1 (Processed) marks an item that was processed
+    before it was journaled, so its values are already in the in-memory rollups; bit 2
+    (HasSource) means the broker name follows the topic.
+    A zero length or bad crc marks the end of a segment (e.g. a torn write or the
+    unused tail of a preallocated memory mapped segment).
+
+    Segments are named journal-<seq>.seg and rotate at segmentBytes.  Only sealed
+    (no longer written) segments are replayed; a segment is deleted once all its
+    records have been written to the database.
+    '''
+    Header = struct.Struct('<II')
+    BodyHeader = struct.Struct('<qBH')
+    Epoch = dt(1970, 1, 1)
+    Processed = 0x02
+    HasSource = 0x04
+
+    def __init__(self, directory, segmentBytes, useMmap=False):
+        self.directory = directory
+        self.segmentBytes = max(64*1024, segmentBytes)
+        self.useMmap = useMmap
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        existing = self._segments()
+        self.seq = (self._seqOf(existing[-1]) + 1) if existing else 0
+        self.file = None
+        self.map = None
+        self.offset = 0
+        self.records = 0            # records in the active segment
+
+    def _segments(self):
+        return sorted(f for f in os.listdir(self.directory) if f.startswith('journal-') and f.endswith('.seg'))
+
+    def _seqOf(self, name):
+        return int(name[len('journal-'):-len('.seg')])
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f'journal-{seq:08d}.seg')
+
+    def _open(self):
+        path = self._path(self.seq)
+        self.file = open(path, 'w+b' if self.useMmap else 'ab')
+        self.offset = 0
+        self.records = 0
+        if self.useMmap:
+            self.file.truncate(self.segmentBytes)
+            self.map = mmap.mmap(self.file.fileno(), self.segmentBytes)
+        debug('Opened journal segment "%s".', path)
+
+    def _close(self):
+        ''' Seal the active segment.  Caller holds self.lock. '''
+        if self.file is None:
+            return
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.offset)     # drop the unused preallocated tail
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        if self.records == 0:
+            os.remove(self._path(self.seq))
+        self.records = 0
+        self.seq += 1
+
+    def append(self, items, processed=False):
+        ''' Append received items and push them to stable storage. '''
+        flag = self.Processed if processed else 0
+        with self.lock:
+            for recTime, topic, payload, retain, source, recMono in items:
+                t = topic.encode('utf-8')
+                flags = (1 if retain else 0) | flag
+                header = self.BodyHeader.pack((recTime - self.Epoch) // timedelta(microseconds=1), flags | (self.HasSource if source else 0), len(t))
+                if source:
+                    src = source.encode('utf-8')[:255]
+                    t += bytes((len(src),)) + src
+                body = header + t + payload
+                record = self.Header.pack(len(body), zlib.crc32(body)) + body
+                if self.file is not None and self.offset + len(record) > self.segmentBytes and self.records > 0:
+                    self._close()
+                if self.file is None:
+                    self._open()
+                if self.map is not None and self.offset + len(record) <= self.segmentBytes:
+                    self.map[self.offset:self.offset + len(record)] = record
+                else:
+                    if self.map is not None:       # record bigger than a whole segment; fall back to a plain write
+                        self.map.close()
+                        self.map = None
+                        self.file.truncate(self.offset)
+                        self.file.seek(self.offset)
+                    self.file.write(record)
+                self.offset += len(record)
+                self.records += 1
+            if self.map is not None:
+                self.map.flush()
+            elif self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def pending(self):
+        with self.lock:
+            return self.records > 0 or len(self._segments()) > (1 if self.file is not None else 0)
+
+    def seal(self):
+        ''' Seal the active segment and return the paths of all sealed segments, oldest first. '''
+        with self.lock:
+            self._close()
+            return [os.path.join(self.directory, f) for f in self._segments()]
+
+    def read(self, path):
+        ''' Yield ((RecTime, topic, payload, retain, source, None), processed) for the items in a sealed segment. '''
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + self.Header.size <= len(data):
+            length, crc = self.Header.unpack_from(data, offset)
+            body = data[offset + self.Header.size:offset + self.Header.size + length]
+            if length == 0 or len(body) != length or zlib.crc32(body) != crc:
+                if length != 0:
+                    logger.warning('Journal segment "%s" has a damaged record at offset %d; rest of segment ignored.', path, offset)
+                break
+            recTimeUs, flags, topicLen = self.BodyHeader.unpack_from(body)
+            topicEnd = self.BodyHeader.size + topicLen
+            payloadStart, source = topicEnd, ''
+            if flags & self.HasSource:
+                payloadStart = topicEnd + 1 + body[topicEnd]
+                source = body[topicEnd + 1:payloadStart].decode('utf-8')
+            item = (self.Epoch + timedelta(microseconds=recTimeUs), body[self.BodyHeader.size:topicEnd].decode('utf-8'), body[payloadStart:], flags & 1, source, None)
+            yield item, bool(flags & self.Processed)
+            offset += self.Header.size + length
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+class JournalReplayError(Exception):
+    pass
+
+def GetDbPool():
+    ''' Return the connection pool, creating it on first use.  Raises SqlError if the database is unreachable. '''
+    global DbPool
+    with DbPoolLock:
+        if DbPool is None:
+            poolSize = min(32, max(1, int(PP.WriterThreads)) + 1)     # one spare for housekeeping
+            DbPool = mysql.connector.pooling.MySQLConnectionPool(pool_name=ProgName, pool_size=poolSize, **DbConfig)
+            info('Created database connection pool of %d connections to %s:%s.', poolSize, DbConfig['host'], DbConfig['port'])
+        return DbPool
+
+class DbSession:
+    '''
+    One thread's connection from the shared pool, and the prepared statements made on it.
+
+    A connection idle for more than DbHealthCheckSec is pinged before use.  A
+    connection that fails is returned to the pool, and a replacement is taken
+    (the pool reconnects it).  While the database is unreachable get() returns None
+    at once, and attempts back off exponentially from DbReconnectMinSec to DbReconnectMaxSec.
+    '''
+    def __init__(self):
+        self.conn = None
+        self.cursor = None
+        self.statements = {}        # SQL text => prepared cursor; valid for the life of self.conn
+        self.lastUsed = 0.0
+        self.backoff = 0.0
+        self.nextAttempt = 0.0
+
+    def get(self):
+        ''' Return a usable cursor, or None while the database is unreachable. '''
+        now = time.monotonic()
+        if self.conn is not None and now - self.lastUsed > int(PP.DbHealthCheckSec):
+            try:
+                self.conn.ping(reconnect=False)
+            except SqlError as e:
+                logger.warning('Database connection failed health check: %s', e)
+                self.broken()
+        if self.conn is None:
+            if now < self.nextAttempt:
+                return None
+            try:
+                self.conn = GetDbPool().get_connection()
+                self.cursor = self.conn.cursor()
+                if self.backoff > 0:
+                    info('Reconnected to database.')
+                self.backoff = 0.0
+            except SqlError as e:
+                self.conn = None
+                self.cursor = None
+                self.backoff = min(max(self.backoff*2, float(PP.DbReconnectMinSec)), float(PP.DbReconnectMaxSec))
+                self.nextAttempt = now + self.backoff
+                logger.error('Could not get a database connection (%s); next attempt in %.0f sec.', e, self.backoff)
+                return None
+        self.lastUsed = now
+        return self.cursor
+
+    def statement(self, sql):
+        ''' Prepared cursor for sql.  The server parses sql once per connection. '''
+        cursor = self.statements.get(sql)
+        if cursor is None:
+            cursor = self.conn.cursor(prepared=True)
+            self.statements[sql] = cursor
+        return cursor
+
+    def commit(self):
+        start = time.perf_counter()
+        self.conn.commit()
+        MCommitSeconds.observe(time.perf_counter() - start)
+
+    def failed(self, e):
+        ''' Clean up after a failed statement; drop the connection if the error means it is unusable. '''
+        if IsConnectionError(e):
+            logger.warning('Database connection lost: %s', e)
+            self.broken()
+            return
+        try:
+            self.conn.rollback()
+        except SqlError:
+            self.broken()
+
+    def broken(self):
+        MDbLost.inc()
+        self.close()
+        self.nextAttempt = time.monotonic()     # first reconnect attempt is immediate
+
+    def close(self):
+        ''' Return the connection to the pool. '''
+        if self.conn is not None:
+            for cursor in [self.cursor] + list(self.statements.values()):
+                try:
+                    cursor.close()
+                except SqlError:
+                    pass
+            try:
+                self.conn.close()
+            except SqlError:
+                pass
+        self.conn = None
+        self.cursor = None
+        self.statements = {}
+
+def IsConnectionError(e):
+    ''' True if e means the database could not be reached, rather than that it rejected a statement. '''
+    return isinstance(e, (SqlInterfaceError, SqlOperationalError))
+
+def CurrentSession():
+    ''' The calling thread's DbSession. '''
+    session = getattr(DbSessions, 'session', None)
+    if session is None:
+        session = DbSession()
+        DbSessions.session = session
+    return session
+
+def ExecuteRows(session, sqlHead, rowValues, rows, sqlTail='', maxRows=None):
+    '''
+    Execute "<sqlHead> VALUES <rowValues>, <rowValues>, ... <sqlTail>" for all rows with
+    prepared statements and bound parameters.
+
+    Rows are sent in chunks of maxRows, or the largest power of two that fits,
+    so each connection prepares only a few distinct statements.
+    '''
+    maxRows = maxRows or len(rows)
+    start = 0
+    while start < len(rows):
+        remaining = len(rows) - start
+        n = maxRows if remaining >= maxRows else 1 << (remaining.bit_length() - 1)
+        sql = f'{sqlHead} VALUES {", ".join([rowValues]*n)}{sqlTail}'
+        t = time.perf_counter()
+        session.statement(sql).execute(sql, [v for row in rows[start:start + n] for v in row])
+        MStatementSeconds.observe(time.perf_counter() - t)
+        start += n
+
+def JournalItems(items, what, processed=False):
+    '''
+    Save items the database did not accept; returns False if there is no journal.
+    processed is True for items that already went through ProcessMessage.
+    '''
+    if Journal is None:
+        logger.error('No journal; %d %s lost.', len(items), what)
+        return False
+    try:
+        Journal.append(items, processed)
+        info('Journaled %d %s for later replay.', len(items), what)
+        return True
+    except OSError as e:
+        logger.exception('Could not journal %d %s: %s', len(items), what, e)
+        return False
+
+def InsertMessageRows(rows, replaying=False):
+    '''
+    Write a batch of (table, columns, values, received item, timing) rows with multi-row
+    prepared inserts, one per table, and commit once.  timing is from ProcessMessage,
+    or None if the item has no monotonic receive stamp.
+
+    If the database does not accept the batch, the received items are journaled,
+    except while replaying the journal: then they are left in their segment and
+    False is returned.  Replay uses INSERT IGNORE since part of a segment may
+    already have been written.
+    '''
+    schema = PP.get('DbSchema')
+    ignore = 'IGNORE ' if replaying else ''
+    byTable = {}
+    for table, columns, values, item, timing in rows:
+        byTable.setdefault((table, columns), []).append(values)
+    session = CurrentSession()
+    cursor = session.get()
+    if cursor is not None:
+        try:
+            started = time.monotonic()
+            for (table, columns), values in byTable.items():
+                SqlInsert = f"""INSERT {ignore}INTO `{schema}`.`{table}` ({', '.join(columns)})"""
+                rowValues = '(' + ', '.join(['%s']*len(columns)) + ')'
+                ExecuteRows(session, SqlInsert, rowValues, values, maxRows=max(int(PP.BatchMaxRows), int(PP.JournalReplayBatchRows)))
+            executed = time.monotonic()
+            session.commit()
+            RecordLatency(rows, started, executed, time.monotonic())
+            info('Inserted %d messages.', len(rows))
+            MBatchRows.observe(len(rows))
+            for (table, columns), values in byTable.items():
+                MRowsInserted.inc(table, amount=len(values))
+            return True
+        except SqlError as e:
+            MBatchFailures.inc('messages')
+            logger.exception("Exception when inserting %d messages.", len(rows))
+            logger.exception("SqlError message is: %s", e.msg)
+            session.failed(e)
+    else:
+        logger.error('No database connection; %d messages NOT inserted.', len(rows))
+    if not replaying:
+        items = {id(item): item for table, columns, values, item, timing in rows}     # a message may have several rows
+        JournalItems(list(items.values()), 'messages', processed=True)
+    return False
+
+def RecordLatency(rows, started, executed, committed):
+    '''
+    Observe a committed batch's execute and commit times, and each message's wait
+    in the batch and receive-to-commit time.  Messages slower than SlowMessageMs
+    are logged with their stage times.
+    '''
+    MLatency.observe(executed - started, 'execute')
+    MLatency.observe(committed - executed, 'commit')
+    slowSec = int(PP.get('SlowMessageMs') or 0)/1000.0
+    seen = set()
+    for table, columns, values, item, timing in rows:
+        if timing is None or id(item) in seen:
+            continue
+        seen.add(id(item))
+        recMono, queueSec, decodeSec, routeSec, processed = timing
+        total = committed - recMono
+        MLatency.observe(started - processed, 'batch')
+        MLatency.observe(total, 'end_to_end')
+        if 0 < slowSec < total:
+            logger.warning('Slow message on "%s": %.1f ms receive to commit (queue %.1f, decode %.1f, route %.1f, batch %.1f, execute %.1f, commit %.1f ms).',
+                item[1], total*1000, queueSec*1000, decodeSec*1000, routeSec*1000, (started - processed)*1000,
+                (executed - started)*1000, (committed - executed)*1000)
+
+def ObserveDeviceDelay(recTime, devTime):
+    ''' Record how long after the device's own timestamp a message was received. '''
+    if devTime is not None:
+        MLatency.observe(max(0.0, (recTime - devTime).total_seconds()), 'device')
+
+def LogLatency():
+    ''' Log p50/p99 of each latency stage seen so far. '''
+    parts = ['%s %.2f/%.2f' % (stage, MLatency.quantile(0.5, stage)*1000, MLatency.quantile(0.99, stage)*1000)
+             for stage in LatencyStages if MLatency.count(stage) > 0]
+    if len(parts) > 0:
+        info('Latency p50/p99 ms: %s.', ', '.join(parts))
+
+def DbIsConnected():
+    return CurrentSession().get() is not None
+
+def ReplayJournal():
+    '''
+    Write journaled messages to the database in bulk, oldest segment first, keeping
+    their original receive times.  Stops at the first failure; the failing segment
+    is kept and retried at the next replay.  Stranded journals are replayed after
+    this process's own, and each directory is removed once it is empty.
+    '''
+    if dontWriteDb and not PP.get('OnlyWriteDevices', False):
+        return
+    journals = ([Journal] if Journal is not None and Journal.pending() else []) + StrandedJournals
+    if len(journals) == 0 or not DbIsConnected():
+        return
+    for journal in journals:
+        if not ReplayJournalSegments(journal):
+            return
+        if journal is not Journal:
+            StrandedJournals.remove(journal)
+            RemoveJournalDir(journal.directory)
+
+def ReplayJournalSegments(journal):
+    ''' Replay the segments of journal; False if a segment could not be written. '''
+    segments = journal.seal()
+    if len(segments) == 0:
+        return True
+    info('Replaying %d journal segment(s) from "%s".', len(segments), journal.directory)
+    def flushReplay(rows):
+        if not InsertMessageRows(rows, replaying=True):
+            raise JournalReplayError(f'{len(rows)} journaled messages not inserted')
+    batch = MsgBatcher(int(PP.JournalReplayBatchRows), 0, flushReplay)
+    for path in segments:
+        rollups = []        # added once the whole segment is written, so a retried segment is not counted twice
+        try:
+            count = 0
+            for item, processed in journal.read(path):
+                ProcessMessage(item, batch, rollup=False if processed else rollups)
+                count += 1
+            batch.flush()
+        except (JournalReplayError, SqlError) as e:
+            logger.error('Journal replay of "%s" stopped: %s', path, e)
+            return False
+        for args in rollups:
+            Rollups.add(*args)
+        journal.remove(path)
+        info('Replayed %d journaled messages from "%s".', count, path)
+    return True
+
+def FindStrandedJournals(journalDir, live):
+    '''
+    SpillJournals for the subdirectories of journalDir that no running process owns,
+    in the order they can be removed: the worker-N and spill subdirectories not in
+    live (those a running process of this instance owns), e.g. left by a run with
+    more worker processes; and the member-N directories of instances that are no
+    longer running (see ClaimJournalDir), after their own subdirectories.
+    Empty ones are removed at once.
+    '''
+    journals = []
+    try:
+        names = sorted(os.listdir(journalDir))
+    except OSError:
+        return journals
+    for name in names:
+        path = os.path.join(journalDir, name)
+        if name in live or not os.path.isdir(path):
+            continue
+        inner = []
+        if re.fullmatch(r'member-\d+', name):
+            if LockDir(path) is None:       # that instance is running; else the lock is held until this one exits
+                continue
+            inner = FindStrandedJournals(path, ())
+        elif not (name == 'spill' or re.fullmatch(r'worker-\d+', name)):
+            continue
+        try:
+            journal = SpillJournal(path, int(PP.JournalSegmentBytes))
+        except OSError as e:
+            logger.warning('Could not open stranded journal "%s": %s', path, e)
+            continue
+        if journal.pending():
+            info('Found stranded journal "%s"; it is replayed with this process\'s journal.', path)
+        if journal.pending() or len(inner) > 0:
+            journals += inner + [journal]
+        else:
+            RemoveJournalDir(path)
+    return journals
+
+def LockDir(path):
+    ''' An fd of directory path with an exclusive flock() on it, or None if another process holds one. '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def ClaimJournalDir(journalDir):
+    '''
+    Return the journal directory of this instance: journalDir, or if another
+    instance on this host holds it (e.g. another member of the same share group),
+    the first member-N subdirectory of it that none holds.  The directory is
+    flock()ed until this process exits, so two instances never replay or delete
+    each other's segments.  Worker processes use subdirectories of it.
+    '''
+    global JournalDirLock
+    path = journalDir
+    n = 0
+    while True:
+        os.makedirs(path, exist_ok=True)
+        JournalDirLock = LockDir(path)
+        if JournalDirLock is not None:
+            return path
+        n += 1
+        path = os.path.join(journalDir, f'member-{n}')
+
+def RemoveJournalDir(path):
+    try:
+        os.rmdir(path)
+        info('Removed stranded journal directory "%s".', path)
+    except OSError as e:
+        logger.warning('Could not remove stranded journal directory "%s": %s', path, e)
+
+##############  Partition maintenance
+#   Tables RANGE partitioned on UNIX_TIMESTAMP(RecTime) (see the schema notes) get one
+# partition per day or month, created PartitionsAhead periods ahead.  The last
+# partition is a MAXVALUE catch-all, so an insert never fails for want of a partition;
+# new partitions are split off it while it is still empty.  Partitions whose rows are
+# all older than RetentionDays are dropped, which is instant where a DELETE of the
+# same rows would take hours.  The DDL commits implicitly, so it runs between batches.
+
+def PeriodStart(t, period):
+    ''' Start of the day or month containing t. '''
+    return dt(t.year, t.month, 1) if period == 'month' else dt(t.year, t.month, t.day)
+
+def NextPeriod(t, period):
+    ''' Start of the day or month after the one containing t. '''
+    if period == 'month':
+        return dt(t.year + t.month//12, t.month % 12 + 1, 1)
+    return PeriodStart(t, period) + timedelta(days=1)
+
+def EpochSeconds(t):
+    return (t - SpillJournal.Epoch) // timedelta(seconds=1)
+
+def TablePartitions(cursor, schema, table):
+    ''' [(partition name, upper bound in epoch sec, or None for MAXVALUE)] in order; [] if table is not partitioned. '''
+    cursor.execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS"
+                   " WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL"
+                   " ORDER BY PARTITION_ORDINAL_POSITION", (schema, table))
+    return [(name, None if bound == 'MAXVALUE' else int(bound)) for name, bound in cursor.fetchall()]
+
+def MaintainTablePartitions(cursor, schema, table, period, now):
+    ''' Add the partitions table needs up to PartitionsAhead periods after now, then apply the retention policy. '''
+    partitions = TablePartitions(cursor, schema, table)
+    if len(partitions) == 0 or partitions[-1][1] is not None:
+        logger.warning('Table `%s`.`%s` is not partitioned by RANGE with a MAXVALUE last partition; see the schema notes in %s.py.',
+                       schema, table, ProgName)
+        return
+    catchAll = partitions[-1][0]
+    horizon = PeriodStart(now, period)
+    for i in range(int(PP.PartitionsAhead) + 1):
+        horizon = NextPeriod(horizon, period)
+    start = SpillJournal.Epoch + timedelta(seconds=partitions[-2][1]) if len(partitions) > 1 else PeriodStart(now, period)
+    new = []
+    while start < horizon:
+        end = NextPeriod(start, period)
+        new.append(f"PARTITION p{start.strftime('%Y%m' if period == 'month' else '%Y%m%d')} VALUES LESS THAN ({EpochSeconds(end)})")
+        start = end
+    if len(new) > 0:
+        cursor.execute(f"ALTER TABLE `{schema}`.`{table}` REORGANIZE PARTITION {catchAll} INTO "
+                       f"({', '.join(new)}, PARTITION {catchAll} VALUES LESS THAN MAXVALUE)")
+        info('Added %d partitions to `%s`.`%s`; partitions now end at %s.', len(new), schema, table, horizon)
+    retentionDays = int(PP.RetentionDays)
+    if retentionDays <= 0:
+        return
+    cutoff = EpochSeconds(now - timedelta(days=retentionDays))
+    for name, bound in partitions[:-1]:
+        if bound > cutoff:
+            break
+        if PP.RetentionAction == 'archive':
+            archive = f'{table}_{name}'
+            cursor.execute(f"CREATE TABLE `{schema}`.`{archive}` LIKE `{schema}`.`{table}`")
+            cursor.execute(f"ALTER TABLE `{schema}`.`{archive}` REMOVE PARTITIONING")
+            cursor.execute(f"ALTER TABLE `{schema}`.`{table}` EXCHANGE PARTITION {name} WITH TABLE `{schema}`.`{archive}`")
+            info('Archived partition %s of `%s`.`%s` to `%s`.', name, schema, table, archive)
+        cursor.execute(f"ALTER TABLE `{schema}`.`{table}` DROP PARTITION {name}")
+        info('Dropped partition %s of `%s`.`%s`, which ended at %s.', name, schema, table, SpillJournal.Epoch + timedelta(seconds=bound))
+
+def MaintainPartitions():
+    ''' Partition maintenance of each of the PartitionTables; a table whose DDL fails is retried next time. '''
+    period = PP.get('PartitionBy')
+    if not period or DbConfig is None:
+        return
+    session = CurrentSession()
+    now = dt.now(timezone.utc).replace(tzinfo=None)
+    for table in (PP.get('PartitionTables') or PP.get('MsgTable') or '').split():
+        cursor = session.get()
+        if cursor is None:
+            logger.error('No database connection; partition maintenance skipped.')
+            return
+        try:
+            MaintainTablePartitions(cursor, PP.DbSchema, table, period, now)
+        except SqlError as e:
+            logger.error('Partition maintenance of `%s`.`%s` failed: %s', PP.DbSchema, table, e)
+            session.failed(e)
+
+class DeviceCoalescer:
+    '''
+    Last-write-wins buffer of DeviceTable rows keyed by deviceid.
+
+    Writer threads add() rows; flush() writes all waiting rows with one multi-row
+    upsert.  A row whose message is the same as the one last written for that
+    device is skipped, so the retained-message storm after a reconnect costs
+    at most one statement per flush interval.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.pending = {}           # deviceid => ((deviceid, message, statustime), received item)
+        self.written = {}           # deviceid => message last written to the DeviceTable
+
+    def add(self, row, item):
+        with self.lock:
+            self.pending[row[0]] = (row, item)
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+            changed = [(row, item) for row, item in pending.values() if self.written.get(row[0]) != row[1]]
+            if len(pending) > len(changed):
+                debug('Skipped %d unchanged device rows.', len(pending) - len(changed))
+            if len(changed) == 0:
+                return
+            written, unsent = UpsertDeviceRows([row for row, item in changed])
+            for row in written:
+                self.written[row[0]] = row[1]
+            if len(unsent) > 0:
+                unsentIds = {row[0] for row in unsent}
+                JournalItems([item for row, item in changed if row[0] in unsentIds], 'device messages', processed=True)
+
+def UpsertDeviceRows(rows):
+    '''
+    Upsert (deviceid, message, statustime) rows into the DeviceTable and commit.
+    Returns (rows written, rows to retry later because the database can't be reached).
+    If the database rejects the multi-row upsert, the rows are upserted one at a
+    time and a row it rejects (e.g. a message too long for its column) is logged
+    and dropped, so it doesn't hold back the others.
+    '''
+    SqlInsert = f"""INSERT INTO `{PP.DbSchema}`.`{PP.DeviceTable}` (deviceid, message, statustime)"""
+    SqlTail = ' ON DUPLICATE KEY UPDATE statustime=VALUES(statustime), message=VALUES(message)'
+    session = CurrentSession()
+    cursor = session.get()
+    if cursor is None:
+        logger.error('No database connection; %d devices NOT inserted.', len(rows))
+        return [], rows
+    try:
+        ExecuteRows(session, SqlInsert, '(%s, %s, %s)', rows, sqlTail=SqlTail)
+        session.commit()
+        info('Upserted %d devices.', len(rows))
+        MRowsInserted.inc(PP.DeviceTable, amount=len(rows))
+        return rows, []
+    except SqlError as e:
+        MBatchFailures.inc('devices')
+        logger.exception("Exception when inserting %d devices.", len(rows))
+        logger.exception("SqlError message is: %s", e.msg)
+        session.failed(e)
+        if IsConnectionError(e):
+            return [], rows
+    written = []
+    for i, row in enumerate(rows):
+        if session.get() is None:
+            return written, rows[i:]
+        try:
+            ExecuteRows(session, SqlInsert, '(%s, %s, %s)', [row], sqlTail=SqlTail)
+            session.commit()
+            written.append(row)
+        except SqlError as e:
+            session.failed(e)
+            if IsConnectionError(e):
+                return written, rows[i:]
+            logger.error('Device "%s" NOT upserted; row dropped: %s', row[0], e)
+    info('Upserted %d of %d devices one at a time.', len(written), len(rows))
+    MRowsInserted.inc(PP.DeviceTable, amount=len(written))
+    return written, []
+
+class SpillWriter:
+    '''
+    Journals the received messages the full ingest queue can't take, on its own
+    thread, so the receive path never waits for a disk flush.  put() only buffers;
+    the thread appends what has gathered as one group, with one flush to disk.
+    While more than maxItems are waiting, new ones are dropped.
+    '''
+    def __init__(self, maxItems):
+        self.maxItems = max(1, maxItems)
+        self.items = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxItems:
+                QueueStats['dropped'] += 1
+                return
+            self.items.append(item)
+            if self.thread is None:         # started on first use; most runs never spill
+                self.thread = threading.Thread(target=self.run, name='SpillWriter', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.items) == 0 and not self.stopping:
+                    self.cond.wait()
+                if len(self.items) == 0:
+                    return
+                items = self.items
+                self.items = []
+            if JournalItems(items, 'spilled messages'):
+                QueueStats['spilled'] += len(items)
+            else:
+                QueueStats['dropped'] += len(items)
+
+    def stop(self, timeout=30):
+        ''' Journal what is waiting, then end the thread. '''
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+def SpillMessage(item):
+    ''' Have the spill thread journal a received message when the ingest queue is full. '''
+    if Spiller is not None:
+        Spiller.put(item)
+    else:
+        QueueStats['dropped'] += 1
+
+def Enqueue(item):
+    '''
+    Hand a received message to the writer threads, applying the QueueOverflow policy when full:
+      block      -- wait for room (stalls the mqtt network thread while the DB is slow)
+      dropOldest -- discard the oldest queued message to make room
+      spill      -- append the new message to the on-disk journal (on the SpillWriter thread)
+    In asyncio mode the queue is an asyncio.Queue and block is not allowed.
+    '''
+    policy = PP.QueueOverflow
+    if policy == 'block':
+        IngestQueue.put(item)
+    else:
+        try:
+            IngestQueue.put_nowait(item)
+        except (queue.Full, asyncio.QueueFull):
+            if policy == 'dropOldest':
+                try:
+                    IngestQueue.get_nowait()
+                    IngestQueue.task_done()
+                except (queue.Empty, asyncio.QueueEmpty):
+                    pass
+                QueueStats['dropped'] += 1
+                try:
+                    IngestQueue.put_nowait(item)
+                except (queue.Full, asyncio.QueueFull):
+                    QueueStats['dropped'] += 1
+                    return
+            else:
+                SpillMessage(item)
+                return
+    QueueStats['enqueued'] += 1
+    depth = IngestQueue.qsize()
+    if depth > QueueStats['highWater']: QueueStats['highWater'] = depth
+
+def LogQueueStats():
+    info('Ingest queue depth %d of %d, high water %d; enqueued %d, dropped %d, spilled %d; deadband suppressed %d.',
+        IngestQueue.qsize(), IngestQueue.maxsize, QueueStats['highWater'],
+        QueueStats['enqueued'], QueueStats['dropped'], QueueStats['spilled'],
+        Deadband.suppressed if Deadband is not None else 0)
+
+def WriterLoop(isFirst):
+    '''
+    Body of a DB writer thread.  Takes received messages off IngestQueue, processes
+    them and flushes this thread's batch when it is full or due.  A None item means quit.
+    The first writer also runs the periodic housekeeping tasks.
+    '''
+    batch = MsgBatcher(int(PP.BatchMaxRows), int(PP.BatchMaxLatencyMs)/1000.0, InsertMessageRows)
+    periodic = []           # [interval, function, next run time]
+    if isFirst:
+        now = time.monotonic()
+        for interval, func in PeriodicTasks():
+            periodic.append([interval, func, now + interval])
+        MaintainPartitions()
+        ReplayJournal()           # Journal may hold messages from before a restart.
+    while True:
+        timeout = batch.timeout()
+        for task in periodic:
+            untilTask = max(0.0, task[2] - time.monotonic())
+            timeout = untilTask if timeout is None else min(timeout, untilTask)
+        try:
+            item = IngestQueue.get(timeout=timeout)
+        except queue.Empty:
+            item = False
+        if item is None:
+            IngestQueue.task_done()
+            batch.flush()
+            CurrentSession().close()
+            debug('Writer thread %s quits.', threading.current_thread().name)
+            return
+        if item:
+            try:
+                ProcessMessage(item, batch)
+            except Exception as e:
+                logger.exception(e)
+            IngestQueue.task_done()
+        batch.flushIfDue()
+        for task in periodic:
+            if time.monotonic() >= task[2]:
+                try:
+                    task[1]()
+                except Exception as e:
+                    logger.exception(e)
+                task[2] = time.monotonic() + task[0]
+
+def StartWriters(count):
+    global Writers
+    Writers = [threading.Thread(target=WriterLoop, args=(i == 0,), name=f'DbWriter{i}', daemon=True)
+                for i in range(max(1, count))]
+    for w in Writers:
+        w.start()
+    info('Started %d DB writer thread(s); ingest queue capacity %d, overflow policy "%s".',
+        len(Writers), IngestQueue.maxsize, PP.QueueOverflow)
+
+def StopWriters(timeout=30):
+    ''' Ask writer threads to flush their batches and quit; wait up to timeout seconds. '''
+    for w in Writers:
+        try:
+            IngestQueue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.error('Ingest queue is full; writer threads not told to quit.')
+            break
+    for w in Writers:
+        w.join(timeout)
+    Devices.flush()
+    Rollups.flush(everything=True)
+    CurrentSession().close()
+    if Spiller is not None:
+        Spiller.stop()
+    LogQueueStats()
+    if Journal is not None:
+        Journal.close()
+
+def PeriodicTasks():
+    ''' (interval sec, function) housekeeping done by the first writer. '''
+    tasks = ((int(PP.QueueStatsIntervalSec), LogQueueStats),
+             (int(PP.QueueStatsIntervalSec), LogLatency),
+             (int(PP.JournalReplayIntervalSec), ReplayJournal),
+             (int(PP.DeviceFlushIntervalMs)/1000.0, Devices.flush),
+             (int(PP.RollupFlushSec), Rollups.flush),
+             (int(PP.PartitionCheckSec) if PP.get('PartitionBy') else 0, MaintainPartitions),
+             (int(PP.get('MetricsPublishSec') or 0) if PP.get('MetricsTopic') else 0, PublishMetrics))
+    return [(interval, func) for interval, func in tasks if interval > 0]
+
+##############  asyncio mode
+#   Mqtt receive (MqttAsyncio), message processing and timers are tasks on one
+# event loop.  Blocking DB statements run on DbExecutor's single thread, so the
+# loop never waits on MySQL.
+
+async def AsyncWriter():
+    ''' asyncio counterpart of WriterLoop.  A None item means quit. '''
+    loop = asyncio.get_running_loop()
+    flushes = []            # batches waiting to be written by DbExecutor
+    batch = MsgBatcher(int(PP.BatchMaxRows), int(PP.BatchMaxLatencyMs)/1000.0, flushes.append)
+    while True:
+        try:
+            item = await asyncio.wait_for(IngestQueue.get(), batch.timeout())
+        except asyncio.TimeoutError:
+            item = False
+        if item is None:
+            IngestQueue.task_done()
+            batch.flush()
+        elif item:
+            try:
+                ProcessMessage(item, batch)
+            except Exception as e:
+                logger.exception(e)
+            IngestQueue.task_done()
+        batch.flushIfDue()
+        while len(flushes) > 0:
+            await loop.run_in_executor(DbExecutor, InsertMessageRows, flushes.pop(0))
+        if item is None:
+            return
+
+async def AsyncPeriodic(interval, func):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(DbExecutor, func)
+        except Exception as e:
+            logger.exception(e)
+
+async def AsyncMain():
+    global IngestQueue
+    loop = asyncio.get_running_loop()
+    IngestQueue = asyncio.Queue(maxsize=max(1, int(PP.QueueCapacity)))
+    await loop.run_in_executor(DbExecutor, MaintainPartitions)
+    await loop.run_in_executor(DbExecutor, ReplayJournal)     # Journal may hold messages from before a restart.
+    writer = asyncio.create_task(AsyncWriter())
+    tasks = [asyncio.create_task(AsyncPeriodic(interval, func)) for interval, func in PeriodicTasks()]
+    mqttTasks = [asyncio.create_task(MqttAsyncio.RunForever(b.client, b.host, b.port, 60)) for b in Brokers.values()]
+    stop = asyncio.Event()
+    stopTask = asyncio.create_task(stop.wait())
+    Shutdown.start(lambda: loop.call_soon_threadsafe(stop.set))
+    info('asyncio mode: ingest queue capacity %d, overflow policy "%s".', IngestQueue.maxsize, PP.QueueOverflow)
+    try:
+        await asyncio.wait([writer, stopTask] + mqttTasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in mqttTasks + tasks + [stopTask]:
+            t.cancel()
+        for b in Brokers.values():
+            b.client.disconnect()
+        if not writer.done():
+            await IngestQueue.put(None)         # writer flushes its batch and quits
+            await writer
+
+def AsyncShutdown():
+    ''' Write what is left after the event loop stopped, including messages still queued. '''
+    batch = MsgBatcher(int(PP.BatchMaxRows), 0, InsertMessageRows)
+    while IngestQueue is not None and not IngestQueue.empty():
+        item = IngestQueue.get_nowait()
+        if item:
+            ProcessMessage(item, batch)
+    batch.flush()
+    Devices.flush()
+    Rollups.flush(everything=True)
+    CurrentSession().close()
+    if Spiller is not None:
+        Spiller.stop()
+    LogQueueStats()
+    if Journal is not None:
+        Journal.close()
+
+##############  Worker process mode
+#   With WorkerProcesses > 0 this process only receives: on_message enqueues as
+# usual, and a forwarder thread sends the raw (RecTime, topic, payload, retain,
+# source) items in chunks over a multiprocessing queue to a pool of worker
+# processes.  Each worker decodes, routes and writes with its own writer threads,
+# DB connections and journal, so decoding and SQL formatting use more than one core.
+#   Items are assigned to workers by topic, so a topic's messages stay in order and
+# always meet the same deadband cache and rollup windows.  Device subscriptions
+# made by a worker are passed back to this process on the subscriptions queue.
+
+class BrokerProxy:
+    ''' Stands in for a Broker in a worker process; subscribe() asks the receive process to subscribe. '''
+    def __init__(self, source, requests):
+        self.source = source
+        self.requests = requests
+        self.topics = set()
+
+    def subscribe(self, topic):
+        if topic not in self.topics:
+            self.topics.add(topic)
+            self.requests.put((self.source, topic))
+
+def WorkerProcess(index, count, cfg, sourceColumns, sources, items, subscriptions, logQueue, logLevels):
+    '''
+    Body of worker process index of count.  Takes chunks of received items off items
+    and hands them to this process's writer threads; a None chunk means quit.
+    Worker 0 uses JournalDir itself, so it also replays anything journaled before
+    worker processes were used, and the journals of workers beyond count.  Log records go to the receive process on
+    logQueue, filtered at logLevels, its (root, "__main__") logger levels.
+    '''
+    global PP, dontWriteDb, mqtt_msg_table, SourceColumns, Brokers, IngestQueue
+    for s in (signal.SIGINT,) + MqttShutdown.ShutdownWatcher.Signals:
+        signal.signal(s, signal.SIG_IGN)        # the receive process tells us when to quit
+    MqttLogging.LogToQueue(logQueue, logLevels[0])
+    logger.setLevel(logLevels[1])
+    PP = Prodict.from_dict(cfg)
+    SetLogLevels(cfg)
+    if int(cfg.get('MetricsPort') or 0) > 0:
+        StartMetrics(int(cfg['MetricsPort']) + 1 + index)      # each process has its own metrics
+    dontWriteDb = cfg['DontWriteDb'] or cfg['OnlyWriteDevices']
+    mqtt_msg_table = cfg['MsgTable']
+    SourceColumns = tuple(sourceColumns)
+    Brokers = {source: BrokerProxy(source, subscriptions) for source in sources}
+    journalDir = os.path.expandvars(cfg['JournalDir'])
+    liveJournals = {'spill'} | {f'worker-{i}' for i in range(1, count)}     # the receive process forwards its own spill journal
+    if index > 0:
+        journalDir = os.path.join(journalDir, f'worker-{index}')
+        liveJournals = None
+    if not SetupProcessing(cfg, journalDir, liveJournals):
+        return
+    PP.QueueOverflow = 'block'          # the receive process applies the overflow policy
+    if index > 0:
+        PP.PartitionBy = ''             # worker 0 maintains the partitions
+    IngestQueue = queue.Queue(maxsize=max(1, int(cfg['QueueCapacity'])))
+    StartWriters(int(cfg['WriterThreads']))
+    try:
+        while True:
+            try:
+                chunk = items.get(timeout=5)
+            except queue.Empty:
+                if not multiprocessing.parent_process().is_alive():
+                    logger.error('Receive process is gone; worker process %d quits.', index)
+                    break
+                continue
+            if chunk is None:
+                break
+            for item in chunk:
+                IngestQueue.put(item)
+    finally:
+        StopWriters()
+        if DbPool is not None:
+            DbPool._remove_connections()
+        debug('Worker process %d quits.', index)
+
+def ForwarderLoop(workerQueues):
+    '''
+    Receive process thread that sends received items to the worker processes.
+    Takes what is waiting on IngestQueue (up to BatchMaxRows items), splits it by
+    worker and sends one chunk per worker, so nothing waits for a chunk to fill.
+    Also forwards messages spilled to this process's journal, and logs queue
+    statistics.  A None item means tell the workers to quit, then quit.
+    '''
+    maxItems = max(1, int(PP.BatchMaxRows))
+    periodic = [[interval, func, time.monotonic() + interval] for interval, func in
+                ((int(PP.QueueStatsIntervalSec), LogQueueStats),
+                 (int(PP.get('MetricsPublishSec') or 0) if PP.get('MetricsTopic') else 0, PublishMetrics),
+                 (int(PP.JournalReplayIntervalSec), lambda: ForwardJournal(workerQueues))) if interval > 0]
+    ForwardJournal(workerQueues)         # Journal may hold messages spilled before a restart.
+    while True:
+        try:
+            items = [IngestQueue.get(timeout=1.0)]
+        except queue.Empty:
+            items = []
+        while 0 < len(items) < maxItems and items[-1] is not None:
+            try:
+                items.append(IngestQueue.get_nowait())
+            except queue.Empty:
+                break
+        for i in items:
+            IngestQueue.task_done()
+        quit = len(items) > 0 and items[-1] is None
+        SendToWorkers(workerQueues, items[:-1] if quit else items)
+        if quit:
+            for q in workerQueues:
+                q.put(None)
+            debug('Forwarder thread quits.')
+            return
+        for task in periodic:
+            if time.monotonic() >= task[2]:
+                try:
+                    task[1]()
+                except Exception as e:
+                    logger.exception(e)
+                task[2] = time.monotonic() + task[0]
+
+def SendToWorkers(workerQueues, items):
+    ''' Send items to the workers, each to the worker for its topic.  Blocks while a worker is busy. '''
+    chunks = [[] for q in workerQueues]
+    for item in items:
+        chunks[zlib.crc32(item[1].encode('utf-8')) % len(chunks)].append(item)
+    for q, chunk in zip(workerQueues, chunks):
+        if len(chunk) > 0:
+            q.put(chunk)
+
+def ForwardJournal(workerQueues):
+    ''' Send messages spilled to the receive process's journal to the workers, then delete the segments. '''
+    if Journal is None or not Journal.pending():
+        return
+    for path in Journal.seal():
+        items = [item for item, processed in Journal.read(path)]   # spilled items were never processed
+        for start in range(0, len(items), int(PP.JournalReplayBatchRows)):
+            SendToWorkers(workerQueues, items[start:start + int(PP.JournalReplayBatchRows)])
+        Journal.remove(path)
+        info('Forwarded %d spilled messages from "%s".', len(items), path)
+
+def SubscriptionRelay(subscriptions):
+    ''' Receive process thread that makes the subscriptions worker processes ask for.  None means quit. '''
+    while True:
+        request = subscriptions.get()
+        if request is None:
+            return
+        source, topic = request
+        broker = Brokers.get(source)
+        if broker is not None:
+            broker.subscribe(topic)
+
+def RunWorkerProcesses(cfg, count):
+    ''' Receive from the brokers and have count worker processes do the rest. '''
+    global IngestQueue, Journal, Spiller
+    ctx = multiprocessing.get_context('spawn')      # workers must not inherit mqtt client threads or sockets
+    subscriptions = ctx.Queue()
+    logQueue = ctx.Queue()
+    logReceiver = MqttLogging.ReceiveFromQueue(logQueue)
+    logLevels = (logging.getLogger().getEffectiveLevel(), logger.getEffectiveLevel())
+    workerQueues = [ctx.Queue(maxsize=WorkerQueueChunks) for i in range(count)]
+    workers = [ctx.Process(target=WorkerProcess, name=f'Worker{i}',
+                    args=(i, count, dict(cfg), SourceColumns, list(Brokers), workerQueues[i], subscriptions, logQueue, logLevels))
+                for i in range(count)]
+    for w in workers:
+        w.start()
+    try:
+        Journal = SpillJournal(os.path.join(os.path.expandvars(cfg['JournalDir']), 'spill'), int(cfg['JournalSegmentBytes']), bool(cfg['JournalUseMmap']))
+    except OSError as e:
+        logger.exception('Could not create spill journal; messages the queue can not accept will be lost: %s', e)
+    IngestQueue = queue.Queue(maxsize=max(1, int(cfg['QueueCapacity'])))
+    Spiller = SpillWriter(int(cfg['QueueCapacity']))
+    forwarder = threading.Thread(target=ForwarderLoop, args=(workerQueues,), name='Forwarder', daemon=True)
+    relay = threading.Thread(target=SubscriptionRelay, args=(subscriptions,), name='SubscriptionRelay', daemon=True)
+    forwarder.start()
+    relay.start()
+    info('Started %d worker process(es); ingest queue capacity %d, overflow policy "%s".', count, IngestQueue.maxsize, PP.QueueOverflow)
+    Shutdown.start(DisconnectBrokers)
+    try:
+        RunBrokers()
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        IngestQueue.put(None)           # forwarder sends what is queued, then tells the workers to quit
+        forwarder.join(30)
+        for w in workers:
+            w.join(60)
+            if w.is_alive():
+                logger.error('Worker process %s did not quit; terminating it.', w.name)
+                w.terminate()
+        subscriptions.put(None)
+        relay.join(5)
+        logQueue.put(None)
+        logReceiver.join(5)
+        if Spiller is not None:
+            Spiller.stop()
+        LogQueueStats()
+        if Journal is not None:
+            Journal.close()
+
+def ReceiveTime():
+    '''
+    Receive time (naive UTC, as the DB session time zone is UTC) for a message.
+    RecTime is the message table's primary key, so if the clock has not moved on
+    since the previous message (same microsec, coarse clock, or stepped back),
+    1 microsec is added to the previous time instead, as InstallAgent.py does for
+    its labels.  Times are then unique and increasing in receive order.
+    '''
+    global PrevTimeStamp
+    timeStamp = time.time_ns()//1000    # current microsec since epoch
+    with PrevTimeStampLock:
+        if timeStamp <= PrevTimeStamp:
+            timeStamp = PrevTimeStamp + 1
+        PrevTimeStamp = timeStamp
+    return SpillJournal.Epoch + timedelta(microseconds=timeStamp)
+
 # The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, userdata, flags, rc):
-    global Topics
+#   userdata is the Broker the client belongs to.  MQTT v5 clients (share groups) also pass properties.
+def on_connect(client, userdata, flags, rc, properties=None):
+    MConnects.inc(userdata.name, str(rc))
     if rc == mqtt.MQTT_ERR_SUCCESS:
-        debug('Connected with result code %s',str(rc))
+        debug('Connected to broker "%s" with result code %s', userdata.name, str(rc))
     else:
-        logger.error('Connected with error code %s',str(rc))
+        logger.error('Connected to broker "%s" with error code %s', userdata.name, str(rc))
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     try:
-        debug(f"Subscribing to topic(s): {Topics}")
-        (result, mid) = client.subscribe(list(zip(Topics,[0]*len(Topics))))
+        with userdata.lock:
+            topics = [userdata.filter(t) for t in userdata.topics]
+        debug("Subscribing to topic(s): %s", topics)
+        (result, mid) = client.subscribe(list(zip(topics,[userdata.qos]*len(topics))))
         debug('Subscription result: %s, message id is: %s', result, mid)
     except Exception as e:
         logger.exception(e)
 
 # The callback for when a PUBLISH message is received from the server.
+#   Only enqueues, so receive latency does not depend on how the database behaves.
 def on_message(client, UsersData, msg):
-    global Topics, DBConn, DBCursor, PP
-    debug('in on_message: client "%s", UsersData "%s", msg "%s"', client, UsersData, msg)
+    recTime = ReceiveTime()
+    recMono = time.monotonic()                              # for latency; wall clock may step
+    MReceived.inc(UsersData.name)
+    Enqueue((recTime, msg.topic, msg.payload, msg.retain, UsersData.source, recMono))
+
+# Decode, route and write one received message; runs on a writer thread.
+#   rollup: True adds extracted values to Rollups, False does not, and a list
+# collects the Rollups.add() arguments for the caller to add later.
+def ProcessMessage(item, batch, rollup=True):
+    recTime, msgTopic, payload, retain, source, recMono = item
+    trace = MsgDebug()
+    start = time.monotonic()
+    if recMono is not None:
+        MLatency.observe(start - recMono, 'queue')
     try:
-        decodedMsg = msg.payload.decode("utf-8")
+        decodedMsg = payload.decode("utf-8")
     except UnicodeError as e:
+        MDecodeFailures.inc()
         logger.warning("Error message is: %s", e)
-        h = f'{msg.payload.hex(" ",1)}'
-        # logger.warning(f'hexified msg.payload {h}')
-        b = bytearray.fromhex(h)
-        logger.warning(f'''Exception decoding a message "{b}"; message ignored.''')
+        logger.warning('Exception decoding a message "%s"; message ignored.', payload)
         return
-    msgTopic = str(msg.topic)
-    debug(f'Recieved topic "{msgTopic}", Recieved message {decodedMsg}, retained? {msg.retain}')
-            # check for quit condition
-    if os.path.exists(magicQuitPath):
-        debug(f'Quitting because magic file ("{magicQuitPath}") exists.')
-        debug('Delete magic file.')
-        os.remove(magicQuitPath)
-        info('####################  MqttToDatabase quits  #####################')
-        exit(0)
+    if trace: debug('Recieved topic "%s", Recieved message %s, retained? %s', msgTopic, decodedMsg, retain)
+
+            # For some of my ESP8266 machines, the retain flag is not consistently getting set,
+            # so status topics are routed as device messages whatever their retain flag.
+    decoded = time.monotonic()
+    route = Routes.match(msgTopic, lambda r: r.get('retained') is None or bool(r.retained) == bool(retain))
+    routed = time.monotonic()
+    if route is not None:
+        MRouted.inc(route.topic, route.action)
+    else:
+        MRouted.inc('', 'none')
+    if route is None or route.action == 'ignore':
+        if trace: debug('Message on "%s" ignored by route %s.', msgTopic, route)
+        return
+    if route.action == 'device':
+        StoreDevice(route, item, msgTopic, decodedMsg, trace)
+        return
+    msgDict = None
+    if route.action == 'transform' or route.get('extract'):
+        msgDict = ParseJsonObject(decodedMsg)       # parsed once for transform and extract
+        if msgDict is None and route.action != 'table':
+            if trace: debug('Message for route "%s" is not a JSON object, so it is ignored.', route.topic)
+            return
+    if route.action == 'transform':
+        decodedMsg = TransformMessage(route, msgDict)
+    processed = time.monotonic()
+    decodeSec = (decoded - start) + (processed - routed)      # UTF-8 decode, JSON parse and transform
+    MLatency.observe(decodeSec, 'decode')
+    MLatency.observe(routed - decoded, 'route')
+    timing = (recMono, start - recMono, decodeSec, routed - decoded, processed) if recMono is not None else None
 
     schema = PP.get('DbSchema')     # Handy names for important items
-    table = PP.get('MsgTable')
-            # For some of my ESP8266 machines, the retain flag is not consistently getting set.
-    if msg.retain == 0 and not msgTopic.endswith('/status'):     # => not a retained message
-        if schema is not None and table is not None:
-            SqlInsert = f"""INSERT INTO `{schema}`.`{table}` SET topic='{msgTopic}', message='{decodedMsg}'"""
-            if not dontWriteDb:
-                try:
-                    DBCursor.execute(SqlInsert)
-                    if DBConn.in_transaction: DBConn.commit()
-                except SqlError as e:
-                    logger.exception("Exception when inserting a message.")
-                    logger.exception("SqlError message is: %s", e.msg)
-                finally:
-                    info(f'Inserted message: "{SqlInsert}"')      # After execute SQL; want to minimize time between msg received and insert
+    table = route.get('table') or PP.get('MsgTable')
+    if schema is not None and table is not None:
+        if dontWriteDb:
+            info('Data message NOT inserted: topic "%s", message "%s".', msgTopic, decodedMsg)
+            return
+        filtered = Deadband is not None and DeadbandFilter.applies(route)
+        filterTopic = (source, msgTopic) if source else msgTopic     # same topic on two brokers is two series
+        if route.action != 'extract':
+            if not filtered or Deadband.passes(route, filterTopic, None, MessageFilterValue(route, decodedMsg, msgDict), recTime):
+                batch.add((table, MsgColumns + SourceColumns, (recTime, msgTopic, decodedMsg) + (source,)*len(SourceColumns), item, timing))
             else:
-                info(f'Data message query NOT executed: "{SqlInsert}".')
-        else:
-            debug(f'Sql insert message query NOT executed because either the MsgTable or the DBSchema was not defined.')
+                if trace: debug('Message on "%s" suppressed by deadband.', msgTopic)
+        if route.get('extract') and msgDict is not None:     # a table route still stores a non-JSON message
+            valueTable = route.get('valueTable') or PP.get('ValueTable')
+            for values in ExtractValues(route, recTime, msgTopic, msgDict):
+                if rollup is not False and route.get('rollup') and Rollups is not None:    # before deadband, so statistics see every value
+                    if isinstance(rollup, list):
+                        rollup.append((source, msgTopic, values[2], values[3], recTime))
+                    else:
+                        Rollups.add(source, msgTopic, values[2], values[3], recTime)
+                if not filtered or Deadband.passes(route, filterTopic, values[2], values[3], recTime):
+                    batch.add((valueTable, ValueColumns + SourceColumns, values + (source,)*len(SourceColumns), item, timing))
+    else:
+        if trace: debug('Sql insert message query NOT executed because either the MsgTable or the DBSchema was not defined.')
 
-    else:       # Retained message -- ignored if not a known status message
-        debug(f'Retained message received.')
-        try:
-            msgDict = json.loads(decodedMsg)
-            debug(f'The message payload was successfully decoded to a python object.  {msgDict}')
-        except json.JSONDecodeError as e:
-            debug(f'The retained message payload was not valid JSON, so it is ignored.')
-            # logger.exception(e)
-            return              # Ignore retained messages that are not valid JSON.
-        deviceId = None
-        statusTime = None
-        if msgTopic.endswith('status'):   # Presumably this is one of my devices.
-            debug(f"Retained message topic ends with 'status'.")
-            deviceId = msgDict.get('MachineID')
-            if deviceId is None:
-                debug(f'"{msg.payload}" does not contain a MachineID field;  reject message.')
-                return
-            statusTime = msgDict.get('StatusTime')
-            if statusTime is None:
-                debug(f'"{msg.payload}" does not contain a StatusTime field;  reject message.')
-                return
+def ParseJsonObject(decodedMsg):
+    ''' The JSON object in decodedMsg as a dict, or None if it is not one. '''
+    try:
+        msgDict = JsonLoads(decodedMsg)
+    except ValueError:          # json.JSONDecodeError and orjson.JSONDecodeError are both ValueErrors
+        return None
+    return msgDict if isinstance(msgDict, dict) else None
 
-            thisDeviceTopic = f'{deviceId}/#'
-            if thisDeviceTopic not in Topics:
-                try:
-                    debug(f"Subscribing to topic from status message: {thisDeviceTopic}")
-                    (result, mid) = client.subscribe(thisDeviceTopic)
-                    debug(f'Subscription result: {result}, message id is: {mid}')
-                except Exception as e:
-                    logger.exception(e)
-            Topics.add(thisDeviceTopic)
+def TransformMessage(route, msgDict):
+    ''' Keep only the route's fields of a JSON message. '''
+    fields = route.get('fields')
+    if fields is not None:
+        msgDict = {k: msgDict[k] for k in fields if k in msgDict}
+    return json.dumps(msgDict, separators=(',', ':'))
 
-        if msgTopic.startswith('homeassistant') and msgTopic.endswith('config'):   # Presumably this is a homeassistant config message.
-            debug(f"Retained message is a homeassistant config message.")
-            deviceId = msgDict.get('uniq_id')
-            if deviceId is None:
-                debug(f'"{decodedMsg}" does not contain a "uniq_id" field;  reject message.')
-                return
-            statusTime = dt.now().astimezone().strftime("%Y-%m-%d %H:%M:%S%z (%Z)")  # use now time since homeassistant config messages don't have a time.
-            if statusTime is None:
-                debug(f'Could not fake a status time; reject message.')
-                return
+def JsonField(msgDict, path):
+    ''' Value at a dotted path ("a.b.c") in nested JSON objects, or None. '''
+    value = msgDict
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
 
-        table = PP.get('DeviceTable')
-        if schema is not None and table is not None and deviceId is not None and statusTime is not None:    # we have everything we need to insert into the DeviceTable.
-            SqlInsert = f"""INSERT INTO `{schema}`.`{table}` SET deviceid='{deviceId}', message='{decodedMsg}', statustime='{statusTime}' ON DUPLICATE KEY UPDATE statustime=VALUES(statustime), message=VALUES(message)"""
-            info(SqlInsert)
-            if not dontWriteDb or PP.get('OnlyWriteDevices', False):
-                try:
-                    # info(f'SqlInsert just before execution "{SqlInsert}"')
-                    DBCursor.execute(SqlInsert)
-                    if DBConn.in_transaction: DBConn.commit()
-                except SqlError as e:
-                    logger.exception("Exception when inserting a device.")
-                    logger.exception("SqlError message is: %s", e.msg)
-            else:
-                info(f'''Query NOT executed: "{SqlInsert}".''')
+def ParseDeviceTime(value):
+    '''
+    A device's own timestamp as a naive UTC datetime: epoch seconds (or msec/usec
+    if too large for seconds), or an ISO 8601 string.  None if not understood.
+    '''
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            while abs(value) > 1e11:            # msec or usec since epoch
+                value /= 1000.0
+            return dt.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+        if isinstance(value, str):
+            t = dt.fromisoformat(value.strip())
+            if t.tzinfo is not None:
+                t = t.astimezone(timezone.utc).replace(tzinfo=None)
+            return t
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
+
+def ExtractValues(route, recTime, msgTopic, msgDict):
+    ''' (RecTime, topic, field, value, devtime) rows for the numeric fields named by the route. '''
+    devTime = None
+    if route.get('timeField') is not None:
+        devTime = ParseDeviceTime(JsonField(msgDict, route.timeField))
+        ObserveDeviceDelay(recTime, devTime)
+    rows = []
+    for field in route.extract:
+        value = JsonField(msgDict, field)
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                value = None
+        if isinstance(value, (int, float)) and math.isfinite(value):     # bool is an int; stored as 0 or 1; MySQL has no NaN
+            rows.append((recTime, msgTopic, field, float(value), devTime))
+    return rows
+
+def StoreDevice(route, item, msgTopic, decodedMsg, trace=False):
+    ''' Upsert a device table row from a device status / config message. '''
+    msgDict = ParseJsonObject(decodedMsg)
+    if msgDict is None:
+        if trace: debug('The device message payload was not a valid JSON object, so it is ignored.')
+        return              # Ignore device messages that are not valid JSON.
+    if trace: debug('The message payload was successfully decoded to a python object.  %s', msgDict)
+    deviceId = msgDict.get(route.idField)
+    if deviceId is None:
+        if trace: debug('"%s" does not contain a "%s" field;  reject message.', decodedMsg, route.idField)
+        return
+    if route.get('timeField') is not None:
+        statusTime = msgDict.get(route.timeField)
+        if statusTime is None:
+            if trace: debug('"%s" does not contain a "%s" field;  reject message.', decodedMsg, route.timeField)
+            return
+        ObserveDeviceDelay(item[0], ParseDeviceTime(statusTime))
+    else:
+        statusTime = dt.now().astimezone().strftime("%Y-%m-%d %H:%M:%S%z (%Z)")  # use now time since e.g. homeassistant config messages don't have a time.
+
+    broker = Brokers.get(item[4])       # the device's topics are on the broker its status came from
+    if route.get('subscribe', False) and broker is not None:
+        broker.subscribe(f'{deviceId}/#')
+
+    schema = PP.get('DbSchema')
+    table = PP.get('DeviceTable')
+    if schema is not None and table is not None:    # we have everything we need to insert into the DeviceTable.
+        deviceRow = (deviceId, decodedMsg, statusTime)
+        if trace: debug('Device upsert: %s', deviceRow)
+        if not dontWriteDb or PP.get('OnlyWriteDevices', False):
+            Devices.add(deviceRow, item)        # written by the next Devices.flush()
         else:
-            debug(f'Not all fields for device table insert are defined.')
-            debug(f'schema "{schema}", table "{table}", deviceId "{deviceId}", statusTime "{statusTime}"')
+            info('Device upsert NOT executed: %s.', deviceRow)
+    else:
+        debug('Not all fields for device table insert are defined.')
+        debug('schema "%s", table "%s", deviceId "%s", statusTime "%s"', schema, table, deviceId, statusTime)
+
+def on_disconnect(client, userdata, rc, properties=None):
+    if rc != mqtt.MQTT_ERR_SUCCESS:         # not asked for by disconnect()
+        MDisconnects.inc(userdata.name)
+        logger.warning('Lost connection to broker "%s": %s', userdata.name, mqtt.error_string(rc) if isinstance(rc, int) else rc)
 
-def on_subscribe(client, userdata, mid, granted_qos):
-    debug(f'On subscribe callback, mid = {mid}, userdata = "{userdata}"')
+def on_subscribe(client, userdata, mid, granted_qos, properties=None):
+    debug('On subscribe callback, mid = %s, userdata = "%s"', mid, userdata)
     pass
 
-MqttClient = mqtt.Client()
+##############  Share groups
+#   With ShareGroup set, several MqttToDatabase processes split one broker's load:
+# each topic is subscribed as the MQTT v5 shared subscription $share/<group>/<topic>,
+# and the broker gives each message to just one member of the group.
+#
+#   Ordering: messages on one topic may go to different processes, so rows are
+# only ordered by RecTime, the receive time stamped by whichever process got the
+# message.  A topic's messages keep their publish order only while one process
+# handles them (e.g. while the group has a single member).  Deadband filtering is
+# per process, so it suppresses less; rollup windows from several processes are
+# merged by the upsert.
+#
+#   Brokers do not send retained messages to shared subscriptions, and every
+# process needs the device status messages to learn {deviceId}/# topics.  So the
+# UnsharedTopics (default +/status) are subscribed directly by every member; all
+# members then subscribe the same $share/<group>/{deviceId}/# filters, and a
+# device's messages are split across the group like any other topic.  Each member
+# upserts the same device rows, which is harmless.
+#
+#   Members on one host may share a JournalDir: the first takes it, and each other
+# member journals to a member-N subdirectory of it (ClaimJournalDir).
+
+class Broker:
+    '''
+    A broker we receive from: its own mqtt client and the set of topics subscribed on it.
+
+    source is the name stored in the SourceColumn ('' when there is only one broker).
+    Writer threads add {deviceId}/# topics with subscribe(); on_connect subscribes the
+    whole set again after a reconnect.  topics holds plain topic filters; filter()
+    adds the share group prefix when subscribing.
+    '''
+    def __init__(self, name, host, port, topics, source, shareGroup='', unshared=(), qos=0):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.source = source
+        self.topics = set(topics)
+        self.shareGroup = shareGroup
+        self.unshared = frozenset(unshared)
+        self.qos = qos
+        self.lock = threading.Lock()
+        if shareGroup:
+            self.client = mqtt.Client(userdata=self, protocol=mqtt.MQTTv5)    # shared subscriptions need MQTT v5
+        else:
+            self.client = mqtt.Client(userdata=self)
+        self.client.on_connect = on_connect
+        self.client.on_message = on_message
+        self.client.on_subscribe = on_subscribe
+        self.client.on_disconnect = on_disconnect
+
+    def subscribe(self, topic):
+        with self.lock:
+            if topic in self.topics:
+                return
+            self.topics.add(topic)
+        try:
+            debug('Subscribing to topic "%s" on broker "%s"', topic, self.name)
+            (result, mid) = self.client.subscribe(self.filter(topic), self.qos)
+            debug('Subscription result: %s, message id is: %s', result, mid)
+        except Exception as e:
+            logger.exception(e)
+
+    def filter(self, topic):
+        ''' The subscription filter for topic: in the share group unless every member needs it. '''
+        if not self.shareGroup or topic.startswith('$share/') or topic in self.unshared:
+            return topic
+        return f'$share/{self.shareGroup}/{topic}'
+
+def ParseBrokers(spec, defaultTopics):
+    '''
+    (name, host, port, topics) for each 'name host[:port] [topic ...]' line of the
+    Brokers parameter; lines may also be separated by ';'.
+    '''
+    brokers = []
+    for line in spec.replace(';', '\n').splitlines():
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if len(words) < 2:
+            raise ValueError(f'Broker "{line.strip()}" needs a name and a host')
+        host, port = words[1].rsplit(':', 1) if ':' in words[1] else (words[1], 1883)
+        brokers.append((words[0], host, int(port), words[2:] or defaultTopics))
+    return brokers
+
+def StartMetrics(port):
+    ''' Serve Metrics on port (0: don't). '''
+    if port <= 0:
+        return
+    try:
+        MqttMetrics.StartServer(Metrics, port, PP.get('MetricsHost') or '127.0.0.1')
+    except OSError as e:
+        logger.error('Could not serve metrics on port %d: %s', port, e)
+
+def PublishMetrics():
+    ''' Publish a JSON snapshot of Metrics on MetricsTopic through the first broker (not from worker processes). '''
+    broker = next(iter(Brokers.values()), None)
+    if broker is None or isinstance(broker, BrokerProxy):
+        return
+    broker.client.publish(PP.MetricsTopic, Metrics.json())
+
+def SetLogLevels(cfg):
+    ''' Apply the LogLevel and DebugSampleEvery parameters. '''
+    if cfg.get('LogLevel'):
+        try:
+            logger.setLevel(cfg['LogLevel'].upper())
+        except ValueError as e:
+            logger.error('Bad LogLevel: %s', e)
+    MsgDebug.every = max(0, int(cfg.get('DebugSampleEvery', 1)))
+    if MsgDebug.every > 1 and logger.isEnabledFor(logging.DEBUG):
+        info('Debug logging one message in %d.', MsgDebug.every)
+
+def DisconnectBrokers():
+    ''' Shutdown's stop function: RunBrokers() returns, and its caller drains and flushes. '''
+    for b in Brokers.values():
+        b.client.disconnect()
+
+def RunBrokers():
+    ''' Receive from all Brokers until the first one's loop_forever() returns. '''
+    first, *others = Brokers.values()
+    try:
+        for b in others:                # each extra broker gets its own network thread
+            b.client.connect_async(b.host, b.port, 60)
+            b.client.loop_start()
+        first.client.connect(first.host, first.port, 60)
+        first.client.loop_forever()
+    finally:
+        for b in Brokers.values():
+            b.client.disconnect()
+        for b in others:
+            b.client.loop_stop()
+
+def SetupProcessing(cfg, journalDir, liveJournals=None):
+    '''
+    Create what decoding, routing and writing need: the database pool, journal,
+    spill writer, routing table, deadband filter, device coalescer and rollups.  False if the
+    program can't run.  A process that owns journalDir gives liveJournals, the
+    subdirectories of it that running processes own, and replays the others too.
+    '''
+    global DbConfig, Journal, StrandedJournals, Spiller, Routes, Deadband, Devices, Rollups
+    if not dontWriteDb or PP.get('OnlyWriteDevices', False):
+        DbConfig = dict(host=cfg['DbHost'],
+            port=int(cfg['DbPort']),
+            user=cfg['DbUser'],
+            password=cfg['DbPass'],
+            db=cfg['DbSchema'],
+            charset='utf8mb4',
+            time_zone='+00:00',         # RecTime values we send are UTC.
+            autocommit=False)
+        try:
+            GetDbPool()
+            info('Connected to MySQL database')
+        except SqlError as e:
+            critical(e)
+            logger.error('Failed to connect to database; messages are journaled until it can be reached.')
+        try:
+            Journal = SpillJournal(journalDir, int(cfg['JournalSegmentBytes']), bool(cfg['JournalUseMmap']))
+            info('Journaling messages the database can not accept in "%s".', Journal.directory)
+        except OSError as e:
+            logger.exception('Could not create journal; messages the database can not accept will be lost: %s', e)
+        if liveJournals is not None:
+            StrandedJournals = FindStrandedJournals(journalDir, liveJournals)
+    routesFile = os.path.expandvars(cfg['RoutesFile']) if cfg['RoutesFile'] else os.path.join(ProgPath, ProgName + '_Routes.toml')
+    try:
+        Routes = LoadRoutes(routesFile)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        critical('Could not load routes from "%s": %s', routesFile, e)
+        return False
+    info('Routing table has %d routes; JSON parser is %s.', Routes.count, 'orjson' if orjson is not None else 'json')
+    Deadband = DeadbandFilter(int(cfg['DeadbandCacheSize']))
+    Spiller = SpillWriter(int(cfg['QueueCapacity']))
+    Devices = DeviceCoalescer()
+    Rollups = RollupAggregator(cfg['RollupTablePrefix'], int(cfg['RollupGraceSec']))
+    info('Message batches flush at %d rows or after %d ms.', int(cfg['BatchMaxRows']), int(cfg['BatchMaxLatencyMs']))
+    return True
 
 
 def main():
-    global Topics, mqtt_msg_table, DBConn, DBCursor, dontWriteDb, MqttClient, PP
+    global Brokers, SourceColumns, mqtt_msg_table, dontWriteDb, PP, IngestQueue, DbExecutor, Shutdown
 
     kwargs = {}
     cfg = MakeParams( **kwargs)
@@ -224,7 +2060,6 @@ def main():
     dontWriteDb = cfg['DontWriteDb'] or cfg['OnlyWriteDevices']
 
     db_user = cfg['DbUser']
-    db_pwd  = cfg['DbPass']
     db_host = cfg['DbHost']
     db_port = int(cfg['DbPort'])
     myschema = cfg['DbSchema']
@@ -238,53 +2073,112 @@ def main():
     t = t.split()
     debug('Split topics from config is: "%s".', t)
     Topics = set(t)
-    debug('Topics from config is: "%s".', Topics)
+    Topics.add('+/status')          # Make sure there is a topic to get status messages.
+    debug(f'The initial set of topics is {Topics}')
 
     # if len(Topics) <= 0:
     #     critical('No mqtt subscription topics given or found.  Must exit.')
     #     sys.exit(4)
 
+    try:
+        extraBrokers = ParseBrokers(cfg.get('Brokers') or '', Topics)
+    except ValueError as e:
+        critical('Bad Brokers parameter: %s', e)
+        return
+    brokerList = [('default', mqtt_host, int(mqtt_port), Topics)] if mqtt_host else []
+    brokerList += [(name, host, port, set(topics) | {'+/status'}) for name, host, port, topics in extraBrokers]
+    if len(brokerList) == 0:
+        critical('No mqtt broker given.  Must quit.')
+        return
+    multiBroker = len(brokerList) > 1
+    SourceColumns = (cfg.get('SourceColumn') or 'source',) if multiBroker else ()
+    Brokers = {}
+    shareGroup = cfg.get('ShareGroup') or ''
+    if '/' in shareGroup or '+' in shareGroup or '#' in shareGroup:
+        critical('ShareGroup "%s" may not contain "/", "+" or "#".  Must quit.', shareGroup)
+        return
+    unshared = (cfg.get('UnsharedTopics') or '').split()
+    for name, host, port, topics in brokerList:
+        source = name if multiBroker else ''
+        Brokers[source] = Broker(name, host, port, topics, source, shareGroup, unshared, int(cfg.get('MqttQos') or 0))
+
     info('Database connection args: host: "%s", port: %d, User: "%s", Pass: REDACTED, Schema: "%s"', db_host, db_port, db_user, myschema)
-    info('Mqtt parameters:  host: "%s", port: %d, topic(s): "%s", mqtt msg table: "%s".', mqtt_host, mqtt_port, Topics, mqtt_msg_table)
+    for b in Brokers.values():
+        info('Mqtt broker "%s":  host: "%s", port: %d, topic(s): "%s", mqtt msg table: "%s".', b.name, b.host, b.port, b.topics, mqtt_msg_table)
+    if shareGroup:
+        info('Receiving in MQTT v5 share group "%s"; topics %s are not shared.', shareGroup, unshared)
+    if multiBroker:
+        info('Rows are tagged with the broker name in column "%s".', SourceColumns[0])
 
-    MqttClient.on_connect = on_connect
-    MqttClient.on_message = on_message
-    MqttClient.on_subscribe = on_subscribe
+    if PP.QueueOverflow not in ('block', 'dropOldest', 'spill'):
+        logger.error('Unknown QueueOverflow policy "%s"; using "block".', PP.QueueOverflow)
+        PP.QueueOverflow = 'block'
 
-    if not dontWriteDb or PP.get('OnlyWriteDevices', False):
-        try:
-            DBConn = mysql.connector.connect(host=db_host,
-                port=db_port,
-                user=db_user,
-                password= db_pwd,
-                db=myschema,
-                charset='utf8mb4')
-            if DBConn.is_connected():
-                info('Connected to MySQL database')
-                info(DBConn)
-                DBConn.start_transaction()
-                DBCursor = DBConn.cursor()
-            else:
-                logger.error('Failed to connect to database.')
-                DBConn = None
-                DBCursor = None
-        except SqlError as e:
-            critical(e)
-            DBConn = None
-            DBCursor = None
+    if PP.get('PartitionBy') not in ('', None, 'day', 'month'):       # cfg too: worker processes get cfg
+        logger.error('Unknown PartitionBy "%s"; partition maintenance disabled.', PP.PartitionBy)
+        PP.PartitionBy = cfg['PartitionBy'] = ''
+    if PP.get('RetentionAction') not in ('drop', 'archive'):
+        logger.error('Unknown RetentionAction "%s"; using "drop".', PP.RetentionAction)
+        PP.RetentionAction = cfg['RetentionAction'] = 'drop'
 
-    Topics.add('+/status')          # Make sure there is a topic to get status messages.
-    debug(f'The initial set of topics is {Topics}')
+    try:
+        cfg['JournalDir'] = ClaimJournalDir(os.path.expandvars(cfg['JournalDir']))
+        if cfg['JournalDir'] != os.path.expandvars(PP.JournalDir):
+            info('Another instance uses the journal directory; this one uses "%s".', cfg['JournalDir'])
+    except OSError as e:
+        logger.error('Could not lock journal directory "%s": %s', cfg['JournalDir'], e)
+
+    SetLogLevels(cfg)
+    StartMetrics(int(cfg.get('MetricsPort') or 0))
+    Shutdown = MqttShutdown.ShutdownWatcher(magicQuitPath, int(cfg.get('MagicFilePollSec') or 5))
+
+    if cfg.get('MaintainPartitions'):
+        if not PP.get('PartitionBy'):
+            critical('MaintainPartitions needs PartitionBy "day" or "month".')
+            return
+        if SetupProcessing(cfg, os.path.expandvars(cfg['JournalDir'])):
+            MaintainPartitions()
+            Shutdown.request('partition maintenance is done')
+        return
+
+    workerProcesses = int(cfg.get('WorkerProcesses') or 0)
+    if workerProcesses > 0:
+        if cfg['AsyncMode']:
+            logger.warning('AsyncMode is ignored when WorkerProcesses is set.')
+        RunWorkerProcesses(cfg, workerProcesses)
+        return
+
+    if not SetupProcessing(cfg, os.path.expandvars(cfg['JournalDir']), set()):
+        return
+
+    if cfg['AsyncMode']:
+        if PP.QueueOverflow == 'block':
+            logger.warning('QueueOverflow "block" would stall the event loop; using "spill" in asyncio mode.')
+            PP.QueueOverflow = 'spill'
+        DbExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='DbWriter')
+        try:
+            asyncio.run(AsyncMain())
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            DbExecutor.shutdown(wait=True)
+            AsyncShutdown()
+            if DbPool is not None:
+                DbPool._remove_connections()      # close idle pooled connections
+        return
 
+    IngestQueue = queue.Queue(maxsize=max(1, int(cfg['QueueCapacity'])))
+    StartWriters(int(cfg['WriterThreads']))
+    Shutdown.start(DisconnectBrokers)
     try:
-        MqttClient.connect(mqtt_host, mqtt_port, 60)
-        MqttClient.loop_forever()
+        RunBrokers()
     except Exception as e:
         logger.exception(e)
     finally:
-        MqttClient.disconnect()
-        if DBConn is not None:
-            DBConn.disconnect()
+        if IngestQueue is not None:
+            StopWriters()               # Don't lose messages still queued or waiting in a batch.
+        if DbPool is not None:
+            DbPool._remove_connections()      # close idle pooled connections
 
 if __name__ == "__main__":
     info(f'####################  MqttToDatabase starts @{dt.now()}  #####################')
@@ -292,8 +2186,11 @@ if __name__ == "__main__":
         main()
     except:
         pass     # On any exception, sleep awhile, then quit.  Launchctl will restart.
-    info('Main returned; program errored somehow.  Wait 10 min, then quit -- Launchctl will restart us.')
-    time.sleep(600)
+    if Shutdown is not None and Shutdown.requested:
+        info('####################  MqttToDatabase quits  #####################')
+    else:
+        info('Main returned; program errored somehow.  Wait 10 min, then quit -- Launchctl will restart us.')
+        time.sleep(600)
     info(f'####################  MqttToDatabase all done @{dt.now()}  #####################')
     logging.shutdown()
     pass
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import time
+import asyncio
 import paho.mqtt.client as mqtt
+import MqttAsyncio
+import MqttShutdown
+import MqttLogging
 import sys
 import os
 import argparse
@@ -10,6 +14,7 @@ import logging
 import logging.config
 import logging.handlers
 import json
+import threading
 
 ProgName, ext = os.path.splitext(os.path.basename(sys.argv[0]))
 ProgPath = os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -27,6 +32,7 @@ if os.path.isfile(logConfFileName):
             if 'filename' in config_dict['handlers'][p]:
                 config_dict['handlers'][p]['filename'] = os.path.join(logPath, config_dict['handlers'][p]['filename'])
         logging.config.dictConfig(config_dict)
+        MqttLogging.StartQueueLogging()     # file writes happen on a listener thread, not the mqtt thread
     except Exception as e:
         print("loading logger config from file failed.")
         print(e)
@@ -49,6 +55,50 @@ def GetConfigFilePath():
 Topics = []
 RequiredConfigParams = frozenset(('mqtt_host', 'mqtt_port'))
 magicQuitPath = os.path.expandvars('${HOME}/.Close%s'%ProgName)
+Shutdown = MqttShutdown.ShutdownWatcher(magicQuitPath)    # SIGTERM/SIGHUP or the magic file stop the receive loop
+StampCache = [None, '']     # [second, its formatted "date time" and "zone"]
+Output = None               # BufferedOutput in buffered mode, else lines are printed and flushed one by one
+
+def TimeStamp(nowTime):
+    ''' "YYYY-mm-dd HH:MM:SS.uuuuuu ZONE" local time; the part to the second is formatted once per second. '''
+    second = int(nowTime)
+    if StampCache[0] != second:
+        localtime = time.localtime(nowTime)
+        StampCache[:] = [second, (time.strftime("%Y-%m-%d %H:%M:%S", localtime), time.strftime("%Z", localtime))]
+    dateTime, zone = StampCache[1]
+    return "%s.%06d %s"%(dateTime, (nowTime - second)*1000000, zone)
+
+class BufferedOutput:
+    '''
+    Lines written to stdout through a large buffer, flushed when it fills and every
+    flushSec by a flusher thread, so a busy subscription costs few write syscalls.
+    At most flushSec of output is lost if the program is killed.
+    '''
+    def __init__(self, flushSec, bufferBytes=1 << 20):
+        self.out = open(sys.stdout.fileno(), 'w', buffering=bufferBytes, encoding='utf-8', errors='backslashreplace', closefd=False)
+        self.flushSec = flushSec
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='OutputFlusher', daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        with self.lock:
+            self.out.write(line)
+            self.out.write('\n')
+
+    def flush(self):
+        with self.lock:
+            self.out.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(5)
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.flushSec):
+            self.flush()
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
@@ -78,17 +128,12 @@ def on_subscribe(client, userdata, mid, granted_qos):
     pass
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, UsersData, msg):
-    nowTime = time.time()
-    timeUs = (nowTime - int(nowTime))*1000000
-    localtime = time.localtime(nowTime)
-    outLine = "%s.%06d %s @ [%s] %s"%(time.strftime("%Y-%m-%d %H:%M:%S",localtime),timeUs,time.strftime("%Z", localtime),msg.topic, msg.payload.decode('utf-8'))
+    outLine = "%s @ [%s] %s"%(TimeStamp(time.time()), msg.topic, msg.payload.decode('utf-8', 'backslashreplace'))
+    if Output is not None:
+        Output.write(outLine)           # buffered mode: the line is only written to stdout
+        return
     logger.debug(outLine)
     print(outLine,flush=True)       # redirect stdout to appropriate file.
-    if os.path.exists(magicQuitPath):
-        logger.debug('Quitting because magic file exists.')
-        logger.debug('Delete magic file.')
-        os.remove(magicQuitPath)
-        exit(0)
     pass
 
 logger.info("TimeStampMqttDumper starts")
@@ -100,12 +145,25 @@ RecClient.on_subscribe = on_subscribe
 mqtt.Client.connected_flag = False        #create flag in class
 mqtt.Client.subscribed_flag = False        #create flag in class
 
+async def RunUntilShutdown(mqtt_host, mqtt_port):
+    ''' asyncio mode: run the mqtt client until Shutdown cancels it. '''
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(MqttAsyncio.RunForever(RecClient, mqtt_host, mqtt_port, 60))
+    Shutdown.start(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
 def main():
-    global Topics
+    global Topics, Output
     parser = argparse.ArgumentParser(description = 'Log MQTT messages to stdOut with timestamp.')
     parser.add_argument("-t", "--topic", dest="topic", action="append", help="MQTT topic to which to subscribe.  May be specified multiple times.")
     parser.add_argument("-o", "--host", dest="MqttHost", action="store", help="MQTT host", default=None)
     parser.add_argument("-p", "--port", dest="MqttPort", action="store", help="MQTT host port", type=int, default=None)
+    parser.add_argument("-A", "--asyncio", dest="asyncio", action="store_true", help="Run the mqtt client on an asyncio event loop instead of loop_forever().", default=False)
+    parser.add_argument("-b", "--buffered", dest="buffered", action="store_true", help="Write through a large buffer flushed every --flush-sec, without the debug log copy of each line.", default=False)
+    parser.add_argument("--flush-sec", dest="flushSec", action="store", help="Buffered mode: seconds between flushes of stdout.", type=float, default=None)
     args = parser.parse_args()
 
     config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
@@ -143,6 +201,21 @@ def main():
     if (mqtt_host is None) or (mqtt_port is None) or (len(Topics) == 0):
         logger.critical('No mqtt_host OR no mqtt_port OR no topics; must quit.')
         sys.exit(1)
+    if args.buffered or cfg.getboolean('buffered_output', False):
+        flushSec = args.flushSec if args.flushSec is not None else cfg.getfloat('flush_sec', 1.0)
+        Output = BufferedOutput(max(0.01, flushSec))
+        logger.info('Buffered output, flushed every %.2f sec.', flushSec)
+
+    if args.asyncio:
+        logger.debug('asyncio mode: MQTT server at "%s", on port "%s", for topics "%s".', mqtt_host, mqtt_port, Topics)
+        try:
+            asyncio.run(RunUntilShutdown(mqtt_host, mqtt_port))
+        finally:
+            logger.debug('Executing finally clause.')
+            RecClient.disconnect()
+            if Output is not None:
+                Output.close()
+        return
 
     try:
         logger.debug('Connecting to MQTT server at "%s", on port "%s", for topics "%s".', mqtt_host, mqtt_port, Topics)
@@ -161,10 +234,14 @@ def main():
         localtime = time.localtime(nowTime)
         timeUs = (nowTime - int(nowTime))*1000000
         logger.debug("Begin receive loop at: %s.%06d %s"%(time.strftime("%Y-%m-%d %H:%M:%S", localtime), timeUs,time.strftime("%Z", localtime)))
+        Shutdown.start(RecClient.disconnect)       # loop_forever() returns after a disconnect()
         RecClient.loop_forever()
     finally:
         logger.debug('Executing finally clause.')
         RecClient.disconnect()
+        if Output is not None:
+            Output.close()
+        sys.stdout.flush()
         pass
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 #!/bin/bash
+#   Superseded by TimeSyncServer's own periodic broadcast (broadcast_period_sec, or --broadcast-period).
 until false; do
     mosquitto_pub -h 192.168.0.16 -t "TimeSync/Request" -m "HeartBeat"
     sleep 60
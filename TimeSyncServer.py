@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import time
+import asyncio
 import paho.mqtt.client as mqtt
+import MqttAsyncio
+import MqttShutdown
+import MqttLogging
 import sys
 import os
 import argparse
@@ -10,6 +14,10 @@ import logging
 import logging.config
 import logging.handlers
 import json
+import struct
+import threading
+import itertools
+import random
 
 ProgName, ext = os.path.splitext(os.path.basename(sys.argv[0]))
 ProgPath = os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -27,6 +35,7 @@ if os.path.isfile(logConfFileName):
             if 'filename' in config_dict['handlers'][p]:
                 config_dict['handlers'][p]['filename'] = os.path.join(logPath, config_dict['handlers'][p]['filename'])
         logging.config.dictConfig(config_dict)
+        MqttLogging.StartQueueLogging()     # file writes happen on a listener thread, not the mqtt thread
     except Exception as e:
         print("loading logger config from file failed.")
         print(e)
@@ -49,11 +58,37 @@ def GetConfigFilePath():
 Topics = []
 RequiredConfigParams = frozenset(('mqtt_host', 'mqtt_port', 'mqtt_request_topics', 'mqtt_sync_ms_topic', 'mqtt_sync_topic'))
 magicQuitPath = os.path.expandvars('${HOME}/.Close%s'%ProgName)
+Shutdown = MqttShutdown.ShutdownWatcher(magicQuitPath)    # SIGTERM/SIGHUP or the magic file stop the receive loop
 
 TIME_SYNC_UPDATE_MSEC_TOPIC =    None     # MQTT topic to subscribe for TIME updates
 TIME_SYNC_UPDATE_TOPIC      =    None     # MQTT topic to subscribe for TIME updates
+TIME_SYNC_BINARY_TOPIC      =    None     # MQTT topic for compact binary time broadcasts
+ReplyTopicPrefix            =    'TimeSync/Reply/'    # exchange replies only go to topics starting with it; '' refuses exchanges
+BinaryTopics = set()        # request topics answered in the binary formats
 
 DontPublish = False
+Broadcaster = None          # TimeBroadcaster sending the plain time messages
+Limiter = None              # ReplyLimiter for exchange replies
+
+#   Compact binary time messages, for devices that would rather not parse (or
+# format) decimal strings.  Requests on BinaryTopics are answered with one message
+# instead of the two text ones, all fields little-endian (as on the ESP8266):
+#   broadcast, on TIME_SYNC_BINARY_TOPIC:   int64 microsec since epoch, uint32 sequence
+#   exchange request:                       "T", version 1 (uint8), int64 t0, uint8 reply
+#                                           topic length n, then the n byte UTF-8 reply topic
+#   exchange reply:                         int64 t0, t1, t2, uint32 sequence
+# The sequence number counts the binary messages sent, so a device can tell a
+# repeat or a lost message.  A request that is not exactly an exchange request
+# (e.g. "HeartBeat") is a plain request.
+TimeFormat = struct.Struct('<qI')
+RequestFormat = struct.Struct('<cBqB')
+RequestMagic = b'T'
+RequestVersion = 1
+ReplyFormat = struct.Struct('<qqqI')
+Sequence = itertools.count(1)       # next() is atomic under the GIL
+
+def NextSequence():
+    return next(Sequence) & 0xffffffff
 
 def SendTime(client):
     if not DontPublish:
@@ -61,10 +96,245 @@ def SendTime(client):
         client.publish(TIME_SYNC_UPDATE_TOPIC, str(round(time.time())))
         logger.debug("sent time at %s", time.asctime())
     else:
-        logger.debug(f'Would have published: {TIME_SYNC_UPDATE_MSEC_TOPIC}: {str("%1.3f"%time.time())} ')
-        logger.debug(f'Would have published: {TIME_SYNC_UPDATE_TOPIC}: {round(time.time())} ')
+        logger.debug('Would have published: %s: %1.3f ', TIME_SYNC_UPDATE_MSEC_TOPIC, time.time())
+        logger.debug('Would have published: %s: %d ', TIME_SYNC_UPDATE_TOPIC, round(time.time()))
+
+def SendBinaryTime(client):
+    payload = TimeFormat.pack(NowUs(), NextSequence())
+    if not DontPublish:
+        client.publish(TIME_SYNC_BINARY_TOPIC, payload)
+        logger.debug("sent binary time %s", payload.hex())
+    else:
+        logger.debug('Would have published: %s: %s', TIME_SYNC_BINARY_TOPIC, payload.hex())
+
+Senders = {'text': SendTime, 'binary': SendBinaryTime}     # broadcast format => function
+
+#   Round trip exchange, like NTP over mqtt.  A request payload of
+#       {"reply": "<topic>", "t0": <client send time>}
+# is answered on <topic> with
+#       {"t0": <t0 echoed>, "t1": <server receive time>, "t2": <server send time>}
+# t1 and t2 are microsec since the epoch.  t0 is echoed as sent, so the client may
+# use any units for it.  With t3 the client's receive time, in microsec:
+#       offset = ((t1 - t0) + (t2 - t3))/2      server clock minus client clock
+#       delay  = (t3 - t0) - (t2 - t1)          round trip through the broker
+# Any other request payload (e.g. "HeartBeat") gets the plain time messages from SendTime.
+# The reply topic must start with ReplyTopicPrefix, so a request can't make the
+# server publish, with its broker permissions, on just any topic.
+
+def NowUs():
+    ''' Current microsec since the epoch. '''
+    return time.time_ns()//1000
+
+def ParseRequest(payload, binary=False):
+    ''' (reply topic, t0) from an exchange request payload, or None for a plain request. '''
+    if binary:
+        if len(payload) <= RequestFormat.size:
+            return None
+        magic, version, t0, length = RequestFormat.unpack_from(payload)
+        if magic != RequestMagic or version != RequestVersion or len(payload) != RequestFormat.size + length:
+            return None
+        try:
+            return payload[RequestFormat.size:].decode('utf-8'), t0
+        except UnicodeError:
+            return None
+    try:
+        request = json.loads(payload)
+    except ValueError:          # not JSON, or not UTF-8
+        return None
+    if not isinstance(request, dict) or not isinstance(request.get('reply'), str) or request['reply'] == '':
+        return None
+    return request['reply'], request.get('t0')
+
+def ReplyTopicAllowed(replyTopic):
+    ''' True for a reply topic under ReplyTopicPrefix, without wildcards or control characters. '''
+    return (ReplyTopicPrefix != '' and len(replyTopic) > len(ReplyTopicPrefix) and replyTopic.startswith(ReplyTopicPrefix)
+            and not any(c in '+#' or ord(c) < 0x20 or c == '\x7f' for c in replyTopic))
+
+def SendExchangeReply(client, replyTopic, t0, t1, binary=False):
+    ''' Answer an exchange request received at t1. '''
+    if not ReplyTopicAllowed(replyTopic):
+        logger.warning('Time exchange reply topic %r not allowed; request ignored.', replyTopic)
+        return
+    if Limiter is not None and not Limiter.allow(replyTopic):
+        logger.debug('Time exchange request for "%s" over the rate limit; not answered.', replyTopic)
+        return
+    if binary:
+        payload = ReplyFormat.pack(t0, t1, NowUs(), NextSequence())
+    else:
+        payload = json.dumps({'t0': t0, 't1': t1, 't2': NowUs()}, separators=(',', ':'))
+    if not DontPublish:
+        client.publish(replyTopic, payload)
+        logger.debug('Sent time exchange reply %s to %s', payload.hex() if binary else payload, replyTopic)
+    else:
+        logger.debug('Would have published: %s: %s', replyTopic, payload.hex() if binary else payload)
+
+class TimeBroadcaster:
+    '''
+    Sends the plain time messages (Senders) from its own thread.  Requests are
+    coalesced: the first request starts a window of windowSec, and one broadcast at
+    its end answers every request made in it, so a fleet rebooting together costs
+    one broadcast per window.
+
+    With periodSec > 0 it also broadcasts unasked, on the wall clock boundaries
+    that are multiples of periodSec since the epoch (1: on each second, 60: on each
+    minute).  The next boundary is worked out from the wall clock after every
+    broadcast, so lateness never accumulates, and the waits are on the monotonic
+    clock.  A wait can overshoot, so the last SpinSec before a boundary is spent
+    polling the clock (for at most 2*SpinSec; a boundary moved away by a wall
+    clock step is worked out again).  How late the broadcasts were is logged every reportSec
+    (0: not kept), from at most LateSamples of them, sampled evenly.
+    Periodic broadcasts are sent in each of periodicFormats.
+    '''
+    SpinSec = 0.002
+    LateSamples = 4096
+
+    def __init__(self, client, windowSec, periodSec=0, reportSec=300, periodicFormats=('text',)):
+        self.client = client
+        self.periodicFormats = set(periodicFormats)
+        self.windowSec = max(0.0, windowSec)
+        self.periodSec = max(0.0, periodSec)
+        self.reportSec = reportSec
+        self.wake = threading.Condition()
+        self.due = None             # monotonic time of the pending coalesced broadcast
+        self.requests = 0           # requests waiting for it
+        self.formats = set()        # formats they asked for
+        self.stopped = False
+        self.thread = None
+        self.late = []              # sample of the sec after their boundary of the periodic broadcasts since the last report
+        self.broadcasts = 0         # periodic broadcasts since the last report
+        self.maxLate = 0.0
+        self.missed = 0             # boundaries passed without a broadcast since the last report
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='TimeBroadcaster', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.wake:
+            self.stopped = True
+            self.wake.notify()
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def request(self, format='text'):
+        ''' A plain time request arrived; it is answered at the end of the current window. '''
+        with self.wake:
+            self.requests += 1
+            self.formats.add(format)
+            if self.due is None:
+                self.due = time.monotonic() + self.windowSec
+                self.wake.notify()
+
+    def nextBoundary(self, t):
+        ''' First broadcast boundary after wall clock time t. '''
+        return (t//self.periodSec + 1)*self.periodSec
+
+    def _run(self):
+        nextWall = self.nextBoundary(time.time()) if self.periodSec > 0 else None
+        nextReport = time.monotonic() + self.reportSec
+        while True:
+            with self.wake:
+                while not self.stopped:
+                    now = time.monotonic()
+                    untilPeriodic = nextWall - time.time() if nextWall is not None else None
+                    if untilPeriodic is not None and untilPeriodic > self.periodSec:     # wall clock stepped back
+                        nextWall = self.nextBoundary(time.time())
+                        untilPeriodic = nextWall - time.time()
+                    if self.due is not None and self.due <= now or untilPeriodic is not None and untilPeriodic <= self.SpinSec:
+                        break
+                    waits = [self.due - now] if self.due is not None else []
+                    if untilPeriodic is not None:
+                        waits += [untilPeriodic - self.SpinSec, 1.0]     # look at the wall clock at least each second, in case it is stepped
+                    self.wake.wait(min(waits) if len(waits) > 0 else None)
+                if self.stopped:
+                    return
+                answered = self.requests if self.due is not None and self.due <= now else 0
+                formats = set()
+                if answered > 0:
+                    formats = self.formats
+                    self.due = None
+                    self.requests = 0
+                    self.formats = set()
+            periodic = untilPeriodic is not None and untilPeriodic <= self.SpinSec
+            if periodic:
+                spinEnd = time.monotonic() + 2*self.SpinSec
+                while time.time() < nextWall and time.monotonic() < spinEnd:
+                    pass
+                if time.time() < nextWall:      # wall clock stepped back during the spin
+                    nextWall = self.nextBoundary(time.time())
+                    periodic = False
+                else:
+                    formats |= self.periodicFormats
+            for format in sorted(formats):      # one broadcast also answers the requests waiting, if any
+                Senders[format](self.client)
+            if answered > 1:
+                logger.debug('One broadcast answered %d requests.', answered)
+            if periodic:
+                if self.reportSec > 0:
+                    self.noteLate(time.time() - nextWall)       # boundary to publish handed to the client
+                following = self.nextBoundary(time.time())
+                self.missed += max(0, round((following - nextWall)/self.periodSec) - 1)
+                nextWall = following
+                if self.reportSec > 0 and time.monotonic() >= nextReport:
+                    self.report()
+                    nextReport = time.monotonic() + self.reportSec
+
+    def noteLate(self, late):
+        ''' Keep late in a reservoir sample of the periodic broadcasts since the last report. '''
+        self.broadcasts += 1
+        self.maxLate = max(self.maxLate, late)
+        if len(self.late) < self.LateSamples:
+            self.late.append(late)
+        else:
+            i = random.randrange(self.broadcasts)
+            if i < self.LateSamples:
+                self.late[i] = late
+
+    def report(self):
+        ''' Log how late the periodic broadcasts since the last report were. '''
+        if len(self.late) > 0:
+            late = sorted(self.late)
+            logger.info('%d periodic broadcasts: late by median %.3f ms, 99%% within %.3f ms, max %.3f ms; %d boundaries missed.',
+                self.broadcasts, late[len(late)//2]*1000, late[min(len(late) - 1, int(len(late)*0.99))]*1000, self.maxLate*1000, self.missed)
+        self.late = []
+        self.broadcasts = 0
+        self.maxLate = 0.0
+        self.missed = 0
+
+class ReplyLimiter:
+    '''
+    Rate limits for exchange replies: a requester (reply topic) gets at most one
+    reply per minIntervalSec, and all requesters together at most maxPerSec (a
+    token bucket).  Requests over a limit are not answered; the client retries.
+    '''
+    def __init__(self, minIntervalSec, maxPerSec):
+        self.minIntervalSec = max(0.0, minIntervalSec)
+        self.maxPerSec = max(0.0, maxPerSec)
+        self.tokens = self.maxPerSec
+        self.refilled = time.monotonic()
+        self.lastReply = {}         # reply topic => monotonic time of the last reply
+        self.lock = threading.Lock()
+        self.refused = 0
+
+    def allow(self, requester):
+        now = time.monotonic()
+        with self.lock:
+            last = self.lastReply.get(requester)
+            if last is not None and now - last < self.minIntervalSec:
+                self.refused += 1
+                return False
+            if self.maxPerSec > 0:
+                self.tokens = min(self.maxPerSec, self.tokens + (now - self.refilled)*self.maxPerSec)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.refused += 1
+                    return False
+                self.tokens -= 1
+            if len(self.lastReply) >= 10000:        # forget requesters no longer limited
+                self.lastReply = {k: t for k, t in self.lastReply.items() if now - t < self.minIntervalSec}
+            self.lastReply[requester] = now
+            return True
 
-# The callback for when the client receives a CONNACK response from the server.
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
     logger.info("Connected with result code %s", str(rc))
@@ -96,28 +366,42 @@ def on_disconnect(client, userdata, rc):
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, UsersData, msg):
+    t1 = NowUs()                # receive time, before anything else
     if (msg.topic in Topics):
-        SendTime(client)
-    logger.debug("At %s got [%s]: %s", time.asctime(), msg.topic, str(msg.payload, encoding='utf-8'))
-    if os.path.exists(magicQuitPath):
-        logger.debug('Quitting because magic file exists.')
-        logger.debug('Delete magic file.')
-        os.remove(magicQuitPath)
-        exit(0)
+        binary = msg.topic in BinaryTopics
+        request = ParseRequest(msg.payload, binary)
+        if request is None:
+            Broadcaster.request('binary' if binary else 'text')
+        else:
+            SendExchangeReply(client, *request, t1, binary=binary)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("At %s got [%s]: %s", time.asctime(), msg.topic, msg.payload.decode('utf-8', 'backslashreplace'))
 
 RecClient = mqtt.Client()
 RecClient.on_connect = on_connect
 RecClient.on_message = on_message
 RecClient.on_disconnect = on_disconnect
 
+async def RunUntilShutdown(mqtt_host, mqtt_port):
+    ''' asyncio mode: run the mqtt client until Shutdown cancels it. '''
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(MqttAsyncio.RunForever(RecClient, mqtt_host, mqtt_port, 60))
+    Shutdown.start(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
 def main():
 
-    global Topics, TIME_SYNC_UPDATE_MSEC_TOPIC, TIME_SYNC_UPDATE_TOPIC, DontPublish
+    global Topics, TIME_SYNC_UPDATE_MSEC_TOPIC, TIME_SYNC_UPDATE_TOPIC, TIME_SYNC_BINARY_TOPIC, BinaryTopics, DontPublish, ReplyTopicPrefix, Broadcaster, Limiter
 
     parser = argparse.ArgumentParser(description = 'Respond to Time Sync request messages with current time.')
     parser.add_argument("-t", "--topic", dest="topic", action="append", help="MQTT topic to which to subscribe.  May be specified multiple times.")
     parser.add_argument("-o", "--host", dest="MqttHost", action="store", help="MQTT host", default=None)
     parser.add_argument("-p", "--port", dest="MqttPort", action="store", help="MQTT host port", type=int, default=None)
+    parser.add_argument("-A", "--asyncio", dest="asyncio", action="store_true", help="Run the mqtt client on an asyncio event loop instead of loop_forever().", default=False)
+    parser.add_argument("-b", "--broadcast-period", dest="broadcastPeriod", action="store", help="Also broadcast the time on each multiple of this many seconds since the epoch; 0: only when asked.", type=float, default=None)
     parser.add_argument("-P", "--DontPublish", dest="dontpub", action="store_true", help="Do not actually publish time syncs.", default=False)
     args = parser.parse_args()
 
@@ -141,6 +425,16 @@ def main():
     mqtt_port = cfg['mqtt_port']
     TIME_SYNC_UPDATE_MSEC_TOPIC = cfg['mqtt_sync_ms_topic']
     TIME_SYNC_UPDATE_TOPIC = cfg['mqtt_sync_topic']
+    TIME_SYNC_BINARY_TOPIC = cfg.get('mqtt_sync_binary_topic')
+    BinaryTopics = set(cfg.get('mqtt_binary_request_topics', '').split())
+    periodicFormats = cfg.get('broadcast_formats', 'text').split()
+    ReplyTopicPrefix = cfg.get('mqtt_reply_topic_prefix', ReplyTopicPrefix)
+    if ReplyTopicPrefix == '':
+        logger.info('mqtt_reply_topic_prefix is empty; time exchange requests are refused.')
+    coalesceMs = cfg.getint('coalesce_ms', 100)
+    broadcastPeriod = cfg.getfloat('broadcast_period_sec', 0)
+    jitterReportSec = cfg.getint('jitter_report_sec', 300)
+    Limiter = ReplyLimiter(cfg.getint('reply_min_interval_ms', 1000)/1000.0, cfg.getfloat('max_replies_per_sec', 50))
 
     if config.has_option(cfgSection, 'mqtt_request_topics'):
         t = cfg['mqtt_request_topics']
@@ -155,11 +449,34 @@ def main():
     if (args.MqttHost != None) and (len(args.MqttHost) > 0): mqtt_host = args.MqttHost
     if (args.MqttPort != None) and (len(args.MqttPort) > 0): mqtt_port = args.MqttPort  #DontPublish
     if (args.dontpub != None): DontPublish = args.dontpub
+    if (args.broadcastPeriod != None): broadcastPeriod = args.broadcastPeriod
     mqtt_port = int(mqtt_port)
+    if (len(BinaryTopics) > 0 or 'binary' in periodicFormats) and not TIME_SYNC_BINARY_TOPIC:
+        logger.error('Binary time messages need mqtt_sync_binary_topic; they are disabled.')
+        BinaryTopics = set()
+        periodicFormats = [f for f in periodicFormats if f != 'binary'] or ['text']
+    if any(f not in Senders for f in periodicFormats):
+        logger.error('Unknown broadcast_formats in "%s"; using "text".', ' '.join(periodicFormats))
+        periodicFormats = ['text']
+    Topics = Topics + sorted(BinaryTopics - set(Topics))
     if (mqtt_host is None) or (mqtt_port is None) or (len(Topics) == 0):
         logger.critical('No mqtt_host OR no mqtt_port OR no topics; must quit.')
         sys.exit(1)
 
+    Broadcaster = TimeBroadcaster(RecClient, coalesceMs/1000.0, broadcastPeriod, jitterReportSec, periodicFormats)
+    Broadcaster.start()
+    logger.info('Requests coalesced over %d ms; periodic broadcast on every %s sec boundary.', coalesceMs, broadcastPeriod or 'no')
+
+    if args.asyncio:
+        logger.debug('asyncio mode: MQTT server at "%s", on port "%s", for topics "%s".', mqtt_host, mqtt_port, Topics)
+        try:
+            asyncio.run(RunUntilShutdown(mqtt_host, mqtt_port))
+        finally:
+            logger.debug('Executing finally clause.')
+            Broadcaster.stop()
+            RecClient.disconnect()
+        return
+
     try:
         logger.debug('Connecting to MQTT server at "%s", on port "%s", for topics "%s".', mqtt_host, mqtt_port, Topics)
         RecClient.connect(mqtt_host, mqtt_port, 60)
@@ -176,9 +493,11 @@ def main():
         localtime = time.localtime(nowTime)
         timeUs = (nowTime - int(nowTime))*1000000
         logger.debug("Begin receive loop at: %s.%06d %s"%(time.strftime("%Y-%m-%d %H:%M:%S", localtime), timeUs,time. strftime("%Z", localtime)))
+        Shutdown.start(RecClient.disconnect)       # loop_forever() returns after a disconnect()
         RecClient.loop_forever()
     finally:
         logger.debug('Executing finally clause.')
+        Broadcaster.stop()
         RecClient.disconnect()
         pass
 
@@ -0,0 +1,88 @@
+'''  DeadbandFilter rules and LRU eviction.  Run from the repo root: python -m unittest discover tests  '''
+import os
+import sys
+import unittest
+from datetime import datetime as dt
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prodict import Prodict
+from MqttToDatabase import DeadbandFilter
+
+T0 = dt(2024, 1, 1)
+
+def At(sec):
+    return T0 + timedelta(seconds=sec)
+
+class DeadbandFilterTest(unittest.TestCase):
+    def passes(self, route, values, filter=None):
+        filter = filter or DeadbandFilter(100)
+        return [filter.passes(route, 't', 'v', value, At(i)) for i, value in enumerate(values)]
+
+    def test_applies(self):
+        self.assertFalse(DeadbandFilter.applies(Prodict(topic='#')))
+        self.assertTrue(DeadbandFilter.applies(Prodict(topic='#', changeOnly=True)))
+        self.assertTrue(DeadbandFilter.applies(Prodict(topic='#', deadband=0)))
+
+    def test_absolute_deadband(self):
+        route = Prodict(deadband=0.5)
+        self.assertEqual(self.passes(route, [10, 10.3, 10.5, 10.6, 10.0, 9.9]), [True, False, False, True, True, False])
+
+    def test_percent_deadband(self):
+        route = Prodict(deadbandPercent=10)
+        self.assertEqual(self.passes(route, [100, 109, 111, 100, 99]), [True, False, True, False, True])
+
+    def test_either_deadband_passes(self):
+        route = Prodict(deadband=5, deadbandPercent=1)
+        self.assertEqual(self.passes(route, [1000, 1005, 1011]), [True, False, True])
+
+    def test_change_only(self):
+        route = Prodict(changeOnly=True)
+        self.assertEqual(self.passes(route, [1, 1, 1.0001, 'on', 'on', 'off']), [True, False, True, True, False, True])
+
+    def test_max_silence(self):
+        route = Prodict(deadband=1, maxSilenceSec=3)
+        self.assertEqual(self.passes(route, [5, 5, 5, 5, 5, 5, 5]), [True, False, False, True, False, False, True])
+
+    def test_suppressed_count(self):
+        filter = DeadbandFilter(100)
+        self.passes(Prodict(changeOnly=True), [1, 1, 1, 2], filter)
+        self.assertEqual(filter.suppressed, 2)
+
+    def test_older_value_passes_without_touching_cache(self):
+        filter = DeadbandFilter(100)
+        route = Prodict(changeOnly=True)
+        self.assertTrue(filter.passes(route, 't', 'v', 1, At(10)))
+        self.assertTrue(filter.passes(route, 't', 'v', 1, At(5)))     # replayed from the journal
+        self.assertFalse(filter.passes(route, 't', 'v', 1, At(11)))
+
+    def test_replay_of_failed_write_passes(self):
+        filter = DeadbandFilter(100)
+        route = Prodict(deadband=1)
+        self.assertTrue(filter.passes(route, 't', 'v', 20.0, At(1)))
+        self.assertFalse(filter.passes(route, 't', 'v', 20.0, At(6)))
+        self.assertTrue(filter.passes(route, 't', 'v', 20.0, At(1)))    # its batch failed and was journaled
+        self.assertFalse(filter.passes(route, 't', 'v', 20.0, At(7)))
+
+    def test_keys_are_per_topic_and_field(self):
+        filter = DeadbandFilter(100)
+        route = Prodict(changeOnly=True)
+        self.assertTrue(filter.passes(route, 'a', 'v', 1, At(0)))
+        self.assertTrue(filter.passes(route, 'b', 'v', 1, At(0)))
+        self.assertTrue(filter.passes(route, 'a', None, 1, At(0)))
+        self.assertFalse(filter.passes(route, 'a', 'v', 1, At(1)))
+
+    def test_lru_eviction(self):
+        filter = DeadbandFilter(2)
+        route = Prodict(changeOnly=True)
+        filter.passes(route, 'a', 'v', 1, At(0))
+        filter.passes(route, 'b', 'v', 1, At(0))
+        self.assertFalse(filter.passes(route, 'a', 'v', 1, At(1)))     # a is now the most recently used
+        filter.passes(route, 'c', 'v', 1, At(2))                        # evicts b
+        self.assertEqual(list(filter.cache), [('a', 'v'), ('c', 'v')])
+        self.assertTrue(filter.passes(route, 'b', 'v', 1, At(3)))       # b was forgotten, so it is written
+        self.assertFalse(filter.passes(route, 'c', 'v', 1, At(3)))
+        self.assertEqual(len(filter.cache), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''  Partition boundary math and maintenance DDL.  Run from the repo root: python -m unittest discover tests  '''
+import os
+import sys
+import unittest
+from datetime import datetime as dt
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prodict import Prodict
+import MqttToDatabase
+from MqttToDatabase import PeriodStart, NextPeriod, EpochSeconds, MaintainTablePartitions
+
+def Epoch(*args):
+    return int(dt(*args, tzinfo=timezone.utc).timestamp())
+
+class Cursor:
+    ''' Answers the information_schema query with partitions ((name, bound or None for MAXVALUE)) and records the other statements. '''
+    def __init__(self, partitions):
+        self.partitions = [(name, 'MAXVALUE' if bound is None else str(bound)) for name, bound in partitions]
+        self.statements = []
+
+    def execute(self, sql, args=None):
+        if not sql.startswith('SELECT'):
+            self.statements.append(sql)
+
+    def fetchall(self):
+        return self.partitions
+
+class PeriodTest(unittest.TestCase):
+    def test_period_start(self):
+        t = dt(2024, 2, 29, 23, 59, 59, 999999)
+        self.assertEqual(PeriodStart(t, 'day'), dt(2024, 2, 29))
+        self.assertEqual(PeriodStart(t, 'month'), dt(2024, 2, 1))
+
+    def test_next_period(self):
+        self.assertEqual(NextPeriod(dt(2024, 2, 28, 12), 'day'), dt(2024, 2, 29))
+        self.assertEqual(NextPeriod(dt(2024, 2, 29), 'day'), dt(2024, 3, 1))
+        self.assertEqual(NextPeriod(dt(2024, 12, 31, 23), 'day'), dt(2025, 1, 1))
+        self.assertEqual(NextPeriod(dt(2024, 11, 30), 'month'), dt(2024, 12, 1))
+        self.assertEqual(NextPeriod(dt(2024, 12, 15), 'month'), dt(2025, 1, 1))
+
+    def test_epoch_seconds_is_utc(self):
+        self.assertEqual(EpochSeconds(dt(1970, 1, 1)), 0)
+        self.assertEqual(EpochSeconds(dt(2024, 3, 1)), Epoch(2024, 3, 1))
+        self.assertEqual(EpochSeconds(dt(2024, 3, 1, 0, 0, 0, 999999)), Epoch(2024, 3, 1))     # whole seconds
+
+class MaintainTablePartitionsTest(unittest.TestCase):
+    def setUp(self):
+        self.savedPP = MqttToDatabase.PP
+        MqttToDatabase.PP = Prodict(PartitionsAhead=2, RetentionDays=0, RetentionAction='drop')
+
+    def tearDown(self):
+        MqttToDatabase.PP = self.savedPP
+
+    def test_adds_days_up_to_horizon(self):
+        cursor = Cursor([('p20240101', Epoch(2024, 1, 2)), ('pmax', None)])
+        MaintainTablePartitions(cursor, 's', 't', 'day', dt(2024, 1, 3, 10))
+        self.assertEqual(cursor.statements, ["ALTER TABLE `s`.`t` REORGANIZE PARTITION pmax INTO ("
+            f"PARTITION p20240102 VALUES LESS THAN ({Epoch(2024, 1, 3)}), "
+            f"PARTITION p20240103 VALUES LESS THAN ({Epoch(2024, 1, 4)}), "
+            f"PARTITION p20240104 VALUES LESS THAN ({Epoch(2024, 1, 5)}), "
+            f"PARTITION p20240105 VALUES LESS THAN ({Epoch(2024, 1, 6)}), "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)"])
+
+    def test_months_from_catch_all_only(self):
+        cursor = Cursor([('pmax', None)])
+        MaintainTablePartitions(cursor, 's', 't', 'month', dt(2024, 11, 20))
+        self.assertEqual(cursor.statements, ["ALTER TABLE `s`.`t` REORGANIZE PARTITION pmax INTO ("
+            f"PARTITION p202411 VALUES LESS THAN ({Epoch(2024, 12, 1)}), "
+            f"PARTITION p202412 VALUES LESS THAN ({Epoch(2025, 1, 1)}), "
+            f"PARTITION p202501 VALUES LESS THAN ({Epoch(2025, 2, 1)}), "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)"])
+
+    def test_nothing_to_add(self):
+        cursor = Cursor([('p20240105', Epoch(2024, 1, 6)), ('pmax', None)])
+        MaintainTablePartitions(cursor, 's', 't', 'day', dt(2024, 1, 3, 10))
+        self.assertEqual(cursor.statements, [])
+
+    def test_not_partitioned(self):
+        for partitions in ([], [('p1', Epoch(2024, 1, 2))]):
+            cursor = Cursor(partitions)
+            with self.assertLogs(level='WARNING'):
+                MaintainTablePartitions(cursor, 's', 't', 'day', dt(2024, 1, 3))
+            self.assertEqual(cursor.statements, [])
+
+    def test_retention_drops_whole_partitions_only(self):
+        MqttToDatabase.PP.RetentionDays = 2
+        cursor = Cursor([('p20240101', Epoch(2024, 1, 2)), ('p20240102', Epoch(2024, 1, 3)),
+                         ('p20240103', Epoch(2024, 1, 4)), ('p20240104', Epoch(2024, 1, 5)),
+                         ('p20240105', Epoch(2024, 1, 6)), ('p20240106', Epoch(2024, 1, 7)), ('pmax', None)])
+        MaintainTablePartitions(cursor, 's', 't', 'day', dt(2024, 1, 4, 12))       # cutoff 2024-01-02 12:00
+        self.assertEqual(cursor.statements, ["ALTER TABLE `s`.`t` DROP PARTITION p20240101"])
+
+    def test_retention_archive(self):
+        MqttToDatabase.PP.RetentionDays = 1
+        MqttToDatabase.PP.RetentionAction = 'archive'
+        cursor = Cursor([('p20240101', Epoch(2024, 1, 2)), ('p20240102', Epoch(2024, 1, 3)), ('pmax', None)])
+        MaintainTablePartitions(cursor, 's', 't', 'day', dt(2024, 1, 3, 12))       # cutoff 2024-01-02 12:00
+        self.assertEqual(cursor.statements[-4:], [
+            "CREATE TABLE `s`.`t_p20240101` LIKE `s`.`t`",
+            "ALTER TABLE `s`.`t_p20240101` REMOVE PARTITIONING",
+            "ALTER TABLE `s`.`t` EXCHANGE PARTITION p20240101 WITH TABLE `s`.`t_p20240101`",
+            "ALTER TABLE `s`.`t` DROP PARTITION p20240101"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''  SpillJournal segment format and recovery.  Run from the repo root: python -m unittest discover tests  '''
+import os
+import sys
+import struct
+import tempfile
+import unittest
+import zlib
+from datetime import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MqttToDatabase import SpillJournal
+
+def Items(count, source=''):
+    return [(dt(2024, 1, 2, 3, 4, 5, i), f'home/sensor{i}', b'{"v": %d}' % i, i % 2, source, None) for i in range(count)]
+
+class SpillJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        j = SpillJournal(self.dir, 0)
+        j.append(Items(3))
+        j.append(Items(2, 'broker2'), processed=True)
+        self.assertTrue(j.pending())
+        paths = j.seal()
+        self.assertEqual(len(paths), 1)
+        got = list(j.read(paths[0]))
+        self.assertEqual([item for item, processed in got], Items(3) + Items(2, 'broker2'))
+        self.assertEqual([processed for item, processed in got], [False]*3 + [True]*2)
+
+    def test_record_layout(self):
+        j = SpillJournal(self.dir, 0)
+        recTime = dt(2024, 1, 2, 3, 4, 5, 6)
+        j.append([(recTime, 'a/b', b'xyz', 1, 'src', None)])
+        with open(j.seal()[0], 'rb') as f:
+            data = f.read()
+        length, crc = struct.unpack_from('<II', data)
+        body = data[8:]
+        self.assertEqual(length, len(body))
+        self.assertEqual(crc, zlib.crc32(body))
+        usec, flags, topicLen = struct.unpack_from('<qBH', body)
+        self.assertEqual(usec, (recTime - SpillJournal.Epoch).total_seconds() * 1000000)
+        self.assertEqual(flags, 1 | SpillJournal.HasSource)
+        self.assertEqual(body[11:11 + topicLen], b'a/b')
+        self.assertEqual(body[11 + topicLen:], b'\x03srcxyz')
+
+    def test_segments_rotate(self):
+        j = SpillJournal(self.dir, 0)           # rounded up to the 64 KiB minimum
+        payload = b'x' * 1000
+        j.append([(dt(2024, 1, 1), 't', payload, 0, '', None)] * 150)
+        paths = j.seal()
+        self.assertEqual(len(paths), 3)
+        self.assertTrue(all(os.path.getsize(p) <= j.segmentBytes for p in paths))
+        self.assertEqual(sum(len(list(j.read(p))) for p in paths), 150)
+        self.assertEqual(paths, sorted(paths))
+
+    def test_torn_tail(self):
+        j = SpillJournal(self.dir, 0)
+        j.append(Items(4))
+        path = j.seal()[0]
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)      # last record only partly written
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual([item for item, processed in j.read(path)], Items(3))
+
+    def test_bad_crc_ends_segment(self):
+        j = SpillJournal(self.dir, 0)
+        j.append(Items(1))
+        first = os.path.getsize(j.seal()[0])
+        j = SpillJournal(self.dir, 0)
+        j.append(Items(3))
+        path = j.seal()[1]
+        with open(path, 'r+b') as f:
+            data = bytearray(f.read())
+            data[first // 2] ^= 0xff             # damage the first record of this segment
+            f.seek(0)
+            f.write(data)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(list(j.read(path)), [])
+
+    def test_mmap_tail_dropped(self):
+        j = SpillJournal(self.dir, 0, useMmap=True)
+        j.append(Items(2))
+        path = j.seal()[0]
+        self.assertLess(os.path.getsize(path), j.segmentBytes)
+        self.assertEqual([item for item, processed in j.read(path)], Items(2))
+
+    def test_restart_continues_sequence(self):
+        j = SpillJournal(self.dir, 0)
+        j.append(Items(1))
+        j.close()
+        j = SpillJournal(self.dir, 0)
+        self.assertTrue(j.pending())
+        j.append(Items(1))
+        paths = j.seal()
+        self.assertEqual([os.path.basename(p) for p in paths], ['journal-00000000.seg', 'journal-00000001.seg'])
+        for p in paths:
+            j.remove(p)
+        self.assertFalse(j.pending())
+
+if __name__ == '__main__':
+    unittest.main()
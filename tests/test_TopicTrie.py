@@ -0,0 +1,85 @@
+'''  TopicTrie filter matching and the default routes.  Run from the repo root: python -m unittest discover tests  '''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MqttToDatabase import TopicTrie, DefaultRoutes
+
+def Trie(*filters):
+    trie = TopicTrie()
+    for f in filters:
+        trie.insert(f, f)
+    return trie
+
+class TopicTrieTest(unittest.TestCase):
+    def test_literal_before_plus_before_hash(self):
+        trie = Trie('#', 'a/#', 'a/+', 'a/b', '+/b')
+        self.assertEqual(trie.match('a/b'), 'a/b')
+        self.assertEqual(trie.match('a/c'), 'a/+')
+        self.assertEqual(trie.match('a/c/d'), 'a/#')
+        self.assertEqual(trie.match('x/b'), '+/b')
+        self.assertEqual(trie.match('x/c'), '#')
+
+    def test_specificity_by_earlier_level(self):
+        trie = Trie('a/+/c', '+/b/c')
+        self.assertEqual(trie.match('a/b/c'), 'a/+/c')
+
+    def test_backtracks_when_literal_branch_fails(self):
+        trie = Trie('a/b/c', '+/b/d')
+        self.assertEqual(trie.match('a/b/d'), '+/b/d')
+        self.assertIsNone(trie.match('a/b/e'))
+
+    def test_hash_matches_parent(self):
+        trie = Trie('a/#')
+        self.assertEqual(trie.match('a'), 'a/#')
+        self.assertEqual(trie.match('a/b/c'), 'a/#')
+        self.assertIsNone(trie.match('b'))
+
+    def test_plus_matches_one_level(self):
+        trie = Trie('a/+')
+        self.assertIsNone(trie.match('a'))
+        self.assertIsNone(trie.match('a/b/c'))
+        self.assertEqual(trie.match('a/'), 'a/+')          # an empty level is still a level
+
+    def test_wildcards_skip_dollar_topics(self):
+        trie = Trie('#', '+/status', '$SYS/#')
+        self.assertIsNone(trie.match('$share/status'))
+        self.assertEqual(trie.match('$SYS/broker/uptime'), '$SYS/#')
+        self.assertEqual(trie.match('a/$x'), '#')
+
+    def test_accept_picks_first_accepted_value(self):
+        trie = TopicTrie()
+        trie.insert('a/#', 'retained')
+        trie.insert('a/#', 'any')
+        trie.insert('#', 'fallback')
+        self.assertEqual(trie.match('a/b', lambda v: v != 'retained'), 'any')
+        self.assertEqual(trie.match('a/b', lambda v: v == 'fallback'), 'fallback')
+        self.assertEqual(trie.count, 3)
+
+class DefaultRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.trie = TopicTrie()
+        for route in DefaultRoutes:
+            self.trie.insert(route['topic'], route)
+
+    def route(self, topic, retained):
+        return self.trie.match(topic, lambda r: r.get('retained') in (None, retained))
+
+    def test_status_at_any_depth(self):
+        for topic in ('dev/status', 'a/b/status', 'a/b/c/d/e/f/g/status'):
+            self.assertEqual(self.route(topic, False)['action'], 'device', topic)
+            self.assertEqual(self.route(topic, True)['action'], 'device', topic)
+
+    def test_homeassistant_config(self):
+        for topic in ('homeassistant/config', 'homeassistant/sensor/x/config', 'homeassistant/sensor/node/x/config'):
+            self.assertEqual(self.route(topic, True)['action'], 'device', topic)
+            self.assertEqual(self.route(topic, False)['action'], 'table', topic)
+
+    def test_other_topics(self):
+        self.assertEqual(self.route('a/b', False)['action'], 'table')
+        self.assertEqual(self.route('a/b', True)['action'], 'ignore')
+        self.assertEqual(self.route('status', False)['action'], 'table')
+
+if __name__ == '__main__':
+    unittest.main()